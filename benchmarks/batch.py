@@ -0,0 +1,85 @@
+# Compare brm.transform_batch with transforming each source on its own, on
+# many small sources where only a few of them have any matches.
+import random
+import time
+from argparse import ArgumentParser
+
+import brm
+from brm import Anchor, TokenTransformer, pattern
+
+
+class Bench(TokenTransformer):
+    @pattern("lsqb", "number", "rsqb")
+    def zero_index(self, lsqb, number, rsqb):
+        return [lsqb, number._replace(string="0"), rsqb]
+
+    @pattern("name=print", "string", anchor=Anchor.LINE)
+    def print_statement(self, keyword, value):
+        return self.template("print({value})").substitute(
+            keyword.start, value=value
+        )
+
+    @pattern("minus", "minus")
+    def double_minus(self, first, second):
+        return [first._replace(string="+")]
+
+
+PLAIN = [
+    "x = {name}({name}, {number}) + {name}.{name}",
+    "def {name}(self, {name}):\n    return self.{name} * {number}",
+    "if {name}:\n    {name} = {{{number}: {name}}}",
+    "{name} = ({name}, {number}, '{name}')",
+]
+MATCHING = ["print '{name}'", "y = {name}[{number}]", "z = - - {number}"]
+
+
+def generate_sources(count, ratio, seed):
+    generator = random.Random(seed)
+
+    class Filler(dict):
+        def __missing__(self, key):
+            if key == "name":
+                return generator.choice(["foo", "bar", "baz", "spam"])
+            return str(generator.randrange(100))
+
+    for _ in range(count):
+        lines = [
+            generator.choice(PLAIN).format_map(Filler())
+            for _ in range(generator.randrange(1, 10))
+        ]
+        if generator.random() < ratio:
+            lines.append(generator.choice(MATCHING).format_map(Filler()))
+        yield "\n".join(lines) + "\n"
+
+
+def measure(name, function):
+    started = time.perf_counter()
+    result = function()
+    print(f"{name:>16}: {time.perf_counter() - started:.3f}s")
+    return result
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--ratio", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+
+    transformer = Bench()
+    sources = list(
+        generate_sources(options.files, options.ratio, options.seed)
+    )
+    print(f"{len(sources)} files (numpy: {brm._import_numpy() is not None})")
+    expected = measure(
+        "transform",
+        lambda: [transformer.transform(source) for source in sources],
+    )
+    result = measure(
+        "transform_batch", lambda: brm.transform_batch(transformer, sources)
+    )
+    assert result == expected
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Compare a generated (python -m brm compile-transformer) transformer
+# with the generic one it was compiled from (which also switches to the
+# "fast" engine when all of its patterns are plain token sequences).
+import tempfile
+import timeit
+from argparse import ArgumentParser
+from pathlib import Path
+
+import brm
+
+TRANSFORMER = """
+from brm import Anchor, TokenTransformer, pattern
+
+class Bench(TokenTransformer):
+    def register_arrow(self):
+        return "=>"
+
+    def visit_arrow(self, token):
+        return token._replace(string=":")
+
+    def visit_name(self, token):
+        if token.string == "fn":
+            return token._replace(string="lambda")
+
+    @pattern("lsqb", "number", "rsqb")
+    def index(self, lsqb, number, rsqb):
+        return [lsqb, number._replace(string="0"), rsqb]
+
+    @pattern("name=print", "string", anchor=Anchor.LINE)
+    def print_statement(self, keyword, value):
+        return self.template("print({value})").substitute(
+            keyword.start, value=value
+        )
+"""
+
+SOURCE = """\
+def foo(items, *args):
+    double = fn x => x * 2
+    print "first"
+    return [double(items[1]), items[2] + args[3], {"a": (1, 2)}]
+
+"""
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 20, 200])
+    parser.add_argument("--number", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=10)
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        brm.COMPILED_PATH = Path(directory) / ".compiled"
+        path = Path(directory) / "bench.py"
+        path.write_text(TRANSFORMER)
+
+        generic = brm._import_transformer_module(path).Bench
+        brm.compile_transformer(path, "Bench")
+        compiled = brm._get_compiled_transformer(path, "Bench", generic)
+        assert compiled is not generic
+        print(f"engine: generic {generic.ENGINE}, compiled {compiled.ENGINE}")
+
+        for size in options.sizes:
+            # the fixed cost of a transform dominates on the small sources
+            source = SOURCE * size
+            number = options.number * max(200 // size, 1)
+            assert generic().transform(source) == compiled().transform(source)
+            timings = {}
+            for name, transformer in [
+                ("generic", generic),
+                ("compiled", compiled),
+            ]:
+                transformer = transformer()
+                # the best of a few runs, the rest is noise
+                timings[name] = (
+                    min(
+                        timeit.repeat(
+                            lambda: transformer.transform(source),
+                            repeat=options.repeat,
+                            number=number,
+                        )
+                    )
+                    / number
+                )
+            print(
+                f"{size * SOURCE.count(chr(10)):>5} lines:"
+                f" generic {timings['generic'] * 1000:.3f}ms,"
+                f" compiled {timings['compiled'] * 1000:.3f}ms"
+                f" ({timings['generic'] / timings['compiled']:.2f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# Run the matcher engines side by side on a generated corpus (and the
+# stdlib), report any difference in their matches or outputs and compare
+# their matching throughput.
+import random
+import sys
+import sysconfig
+import time
+import tokenize
+from argparse import ArgumentParser
+from pathlib import Path
+
+import brm
+from brm import Anchor, Budget, TokenTransformer, pattern
+
+
+class Harness(TokenTransformer):
+    @pattern("lsqb", "number", "rsqb")
+    def zero_index(self, lsqb, number, rsqb):
+        return [lsqb, number._replace(string="0"), rsqb]
+
+    @pattern("name=print", "string", anchor=Anchor.LINE)
+    def print_statement(self, keyword, value):
+        return self.template("print({value})").substitute(
+            keyword.start, value=value
+        )
+
+    @pattern("name=self", "dot", "name")
+    def private(self, receiver, dot, name):
+        if not name.string.startswith("_"):
+            return [receiver, dot, name._replace(string=name.string.upper())]
+
+    @pattern("name=import|from", "name", anchor=Anchor.LINE)
+    def imports(self, keyword, name):
+        return [keyword, name._replace(string=name.string[::-1])]
+
+    @pattern("colon", "newline", "indent", anchor=Anchor.ANY)
+    def block(self, colon, newline, indent):
+        return None
+
+    @pattern("lpar", "any", "rpar")
+    def call(self, lpar, *rest):
+        return None
+
+    @pattern("minus", "minus")
+    def double_minus(self, first, second):
+        return [first._replace(string="+")]
+
+
+class FixedPointHarness(Harness):
+    FIXED_POINT = True
+
+    @pattern("plus", "minus")
+    def plus_minus(self, plus, minus):
+        return [minus]
+
+
+LINES = [
+    "x = {name}[{number}] + {name}[{number}]",
+    "print '{name}'",
+    "self.{name} = self._{name} - - - {number}",
+    "import {name}",
+    "from {name} import {name}",
+    "if {name}:\n    {name}({name}, {number})",
+    "def {name}(self, {name}):\n    return self.{name}[{number}]",
+    "{name} = - - {name} if {name} else ({name})",
+]
+
+
+def generate_corpus(count, seed):
+    generator = random.Random(seed)
+
+    def fill(line):
+        return line.format_map(Filler())
+
+    class Filler(dict):
+        def __missing__(self, key):
+            if key == "name":
+                return generator.choice(["foo", "bar", "baz", "spam"])
+            return str(generator.randrange(100))
+
+    for index in range(count):
+        lines = [
+            fill(generator.choice(LINES))
+            for _ in range(generator.randrange(1, 40))
+        ]
+        yield f"<generated {index}>", "\n".join(lines) + "\n"
+
+
+def read_stdlib(limit):
+    paths = sorted(Path(sysconfig.get_paths()["stdlib"]).glob("*.py"))
+    for path in paths[:limit]:
+        try:
+            with tokenize.open(path) as stream:
+                yield str(path), stream.read()
+        except (SyntaxError, UnicodeDecodeError):
+            continue
+
+
+def run_engine(transformer, engine, source):
+    transformer.ENGINE = engine
+    patterns = transformer._pattern_search()
+    stream_tokens = transformer._tokenize(source)
+
+    started = time.perf_counter()
+    matches = list(
+        transformer._find_matches(patterns, stream_tokens, Budget())
+    )
+    elapsed = time.perf_counter() - started
+
+    try:
+        output = transformer.transform(source)
+    except Exception as exc:
+        output = type(exc).__name__
+    matches = sorted(
+        (match.start, match.stop, match.rank) for match in matches
+    )
+    return matches, output, elapsed, len(stream_tokens)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--engines", nargs="+", default=list(brm.ENGINES))
+    parser.add_argument("--generated", type=int, default=500)
+    parser.add_argument("--stdlib", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+
+    corpus = [
+        *generate_corpus(options.generated, options.seed),
+        *read_stdlib(options.stdlib),
+    ]
+    timings = dict.fromkeys(options.engines, 0.0)
+    tokens = 0
+    mismatches = 0
+    for transformer in (Harness(), FixedPointHarness()):
+        for name, source in corpus:
+            results = {}
+            for engine in options.engines:
+                matches, output, elapsed, size = run_engine(
+                    transformer, engine, source
+                )
+                results[engine] = (matches, output)
+                timings[engine] += elapsed
+            tokens += size
+
+            reference, *others = options.engines
+            for engine in others:
+                if results[engine] != results[reference]:
+                    mismatches += 1
+                    print(
+                        f"MISMATCH ({type(transformer).__name__}):"
+                        f" {reference} != {engine} on {name}"
+                    )
+
+    print(f"{len(corpus)} sources, {mismatches} mismatches")
+    for engine, timing in timings.items():
+        print(f"{engine:>10}: {tokens / timing / 1e6:.2f}M tokens/s")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+# Compare exchanging tokens with worker processes through shared memory
+# (brm.transform_many) against pickling the token lists.
+import pickle
+import sysconfig
+import time
+import tokenize
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import brm
+from brm import Budget, TokenTransformer, pattern
+
+
+class Bench(TokenTransformer):
+    @pattern("lsqb", "number", "rsqb")
+    def zero_index(self, lsqb, number, rsqb):
+        return [lsqb, number._replace(string="0"), rsqb]
+
+    def visit_name(self, token):
+        if token.string == "self":
+            return token._replace(string="this")
+
+
+def transform_pickled(transformer, stream_tokens):
+    budget = Budget()
+    return transformer._transform_tokens(
+        transformer._pattern_search(), stream_tokens, budget
+    )
+
+
+def read_sources(limit):
+    paths = sorted(Path(sysconfig.get_paths()["stdlib"]).glob("*.py"))
+    for path in paths[:limit]:
+        try:
+            with tokenize.open(path) as stream:
+                yield stream.read()
+        except (SyntaxError, UnicodeDecodeError):
+            continue
+
+
+def measure(name, function):
+    started = time.perf_counter()
+    result = function()
+    print(f"{name:>24}: {time.perf_counter() - started:.3f}s")
+    return result
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--workers", type=int)
+    options = parser.parse_args()
+
+    transformer = Bench()
+    sources = list(read_sources(options.files))
+    token_lists = [transformer._tokenize(source) for source in sources]
+    print(f"{len(sources)} files, {sum(map(len, token_lists))} tokens")
+
+    measure(
+        "pickle round trip",
+        lambda: [pickle.loads(pickle.dumps(tokens)) for tokens in token_lists],
+    )
+    measure(
+        "token buffer round trip",
+        lambda: [
+            list(brm.TokenBuffer(brm.TokenBuffer.encode(tokens)))
+            for tokens in token_lists
+        ],
+    )
+
+    def pickled():
+        with ProcessPoolExecutor(options.workers) as executor:
+            futures = [
+                executor.submit(
+                    transform_pickled,
+                    transformer,
+                    transformer._tokenize(source),
+                )
+                for source in sources
+            ]
+            return [tokenize.untokenize(future.result()) for future in futures]
+
+    expected = measure("process pool (pickle)", pickled)
+    result = measure(
+        "process pool (shared)",
+        lambda: list(
+            brm.transform_many(transformer, sources, options.workers)
+        ),
+    )
+    assert result == expected
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,49 @@
+import bisect
 import codecs
+import hashlib
 import importlib.util
 import inspect
 import io
+import itertools
+import json
+import linecache
+import mmap
+import os
 import re
+import socket
+import socketserver
+import struct
 import sys
+import tempfile
+import threading
+import time
 import token
 import tokenize
+import warnings
+from array import array
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 from enum import IntEnum
 from functools import partial
 from pathlib import Path
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
 TRANSFORMER_PATH = Path("~/.brm").expanduser()
 TRANSFORMER_PATH.mkdir(exist_ok=True)
+MANIFEST_PATH = TRANSFORMER_PATH / "manifest.json"
+MANIFEST_VERSION = 2
+SOCKET_PATH = TRANSFORMER_PATH / "brm.sock"
+COMPILED_PATH = TRANSFORMER_PATH / ".compiled"
+COMPILED_VERSION = 3
 
 if sys.version_info < (3, 8):
     token.COLONEQUAL = 0xFF
@@ -30,6 +62,19 @@ token.EXACT_TOKEN_NAMES = dict(
 
 EXPANDS = {"any": "(.*?)"}
 
+CONFLICT_POLICIES = {
+    "leftmost-longest": lambda match: (
+        match.start,
+        match.start - match.stop,
+        match.rank,
+    ),
+    "priority": lambda match: (
+        match.rank,
+        match.start,
+        match.start - match.stop,
+    ),
+}
+
 
 class Slice:
     def __init__(self, *args):
@@ -41,10 +86,58 @@ class Slice:
         self.s = slice(start, stop)
 
 
-class TextStreamTokenPosition:
-    def __init__(self, start, end):
-        self.start = start
-        self.end = end
+class Pattern:
+    def __init__(
+        self, regex, reach, anchor, requires, constraints, parts=None
+    ):
+        self.regex = regex
+        # maximum number of tokens a match can span (None => unbounded)
+        self.reach = reach
+        self.anchor = anchor
+        # names of the token types every match contains
+        self.requires = requires
+        # group name => allowed token strings
+        self.constraints = constraints
+        self.leading = constraints.get("c0")
+        # (name, allowed strings or None) for each token of the patterns
+        # that match a fixed sequence of token types (None => not fixed)
+        self.parts = parts
+
+    def match(self, text, pos=0):
+        return self.regex.match(text, pos)
+
+
+class Match(Slice):
+    def __init__(self, start, stop, visitor, rank):
+        super().__init__(start, stop)
+        self.visitor = visitor
+        self.rank = rank
+
+    @property
+    def start(self):
+        return self.s.start
+
+    @property
+    def stop(self):
+        return self.s.stop
+
+
+class Intervals:
+    # Sorted set of disjoint [start, stop) intervals
+    def __init__(self):
+        self.starts = []
+        self.stops = []
+
+    def overlaps(self, start, stop):
+        index = bisect.bisect_right(self.starts, start)
+        if index and self.stops[index - 1] > start:
+            return True
+        return index < len(self.starts) and self.starts[index] < stop
+
+    def add(self, start, stop):
+        index = bisect.bisect_right(self.starts, start)
+        self.starts.insert(index, start)
+        self.stops.insert(index, stop)
 
 
 class Priority(IntEnum):
@@ -72,6 +165,14 @@ class Priority(IntEnum):
         return func
 
 
+class Anchor(IntEnum):
+    ANY = 0
+    # start of a logical line (including the ones after INDENT/DEDENTs)
+    LINE = 1
+    # right after an INDENT/DEDENT
+    BLOCK = 2
+
+
 class PatternError(Exception):
     pass
 
@@ -84,6 +185,94 @@ class NoLineTransposer(Transposer):
     pass
 
 
+class BudgetExceeded(Exception):
+    def __init__(self, budget, limit, value):
+        super().__init__(f"{budget} budget exceeded ({value} > {limit})")
+        self.budget = budget
+        self.limit = limit
+        self.value = value
+
+
+class BudgetWarning(RuntimeWarning):
+    def __init__(self, transformer, exc):
+        super().__init__(f"{type(transformer).__name__} skipped, {exc}")
+        self.transformer = type(transformer).__name__
+        self.budget = exc.budget
+        self.limit = exc.limit
+        self.value = exc.value
+
+
+class Trace:
+    # Writes the events of a transform as compact JSON lines:
+    #   ["tokens", [[type, string, start, end], ...]]   (start of a pass,
+    #                                                     if they changed)
+    #   ["pattern", id, regex, visitor]
+    #   ["visit", index, type]
+    #   ["attempt", pattern id, index]
+    #   ["match", pattern id, start, stop]
+    #   ["replace", start, stop, tokens or null (line removed)]
+    def __init__(self, stream):
+        self.stream = stream
+        self.tokens = None
+
+    def emit(self, *event):
+        self.stream.write(json.dumps(event, separators=(",", ":")) + "\n")
+
+    def emit_tokens(self, stream_tokens):
+        stream_tokens = list(stream_tokens)
+        if stream_tokens != self.tokens:
+            self.tokens = stream_tokens
+            self.emit("tokens", self.dump_tokens(stream_tokens))
+
+    def dump_tokens(self, stream_tokens):
+        return [
+            [
+                token.tok_name[token.EXACT_TOKEN_TYPES.get(string, toktype)],
+                string,
+                start,
+                end,
+            ]
+            for toktype, string, start, end, _ in stream_tokens
+        ]
+
+
+class Budget:
+    def __init__(self, max_time=None, max_attempts=None, max_growth=None):
+        self.max_time = max_time
+        self.max_attempts = max_attempts
+        self.max_growth = max_growth
+        self.started = time.perf_counter()
+        self.attempts = 0
+        self.max_tokens = None
+
+    def start(self, stream_tokens):
+        if self.max_growth is not None:
+            self.max_tokens = int(len(stream_tokens) * self.max_growth)
+
+    def exclude(self, seconds):
+        # time spent on something else (e.g. the other fused transformers)
+        self.started += seconds
+
+    def check_time(self):
+        if self.max_time is not None:
+            elapsed = time.perf_counter() - self.started
+            if elapsed > self.max_time:
+                raise BudgetExceeded("time", self.max_time, elapsed)
+
+    def attempt(self):
+        self.attempts += 1
+        if self.max_attempts is not None and self.attempts > self.max_attempts:
+            raise BudgetExceeded("attempts", self.max_attempts, self.attempts)
+        self.check_time()
+
+    def grow(self, stream_tokens):
+        if (
+            self.max_tokens is not None
+            and len(stream_tokens) > self.max_tokens
+        ):
+            raise BudgetExceeded("growth", self.max_tokens, len(stream_tokens))
+
+
 def _clear_name(name):
     if not name.isalpha():
         index = -1
@@ -121,11 +310,71 @@ def get_type_from_name(name):
     return f"{prefix}{name}"
 
 
-def pattern(*pattern_tokens):
+def _get_reach(prefix, pattern_part):
+    if pattern_part in EXPANDS or any(
+        quantifier in pattern_part for quantifier in "*+{"
+    ):
+        return None
+    # each word can match at most one token
+    reach = max(len(re.findall("[a-z]+", pattern_part, re.I)), 1)
+
+    if not prefix or prefix == "?":
+        return reach
+    elif prefix in {"*", "+"} or prefix.endswith(",}"):
+        return None
+
+    bounds = re.fullmatch(r"\{(\d*),?(\d+)\}", prefix)
+    if bounds is None:
+        return None
+    return reach * int(bounds.group(2))
+
+
+def _is_required(prefix, pattern_part):
+    if not pattern_part.isalpha() or pattern_part in EXPANDS:
+        return False
+    return prefix in {"", "+"} or bool(
+        re.fullmatch(r"\{0*[1-9]\d*(,\d*)?\}", prefix)
+    )
+
+
+def pattern(*pattern_tokens, anchor=Anchor.ANY):
     def wrapper(func):
         pattern_template_buffer = ""
+        reach = 0
+        requires = set()
+        constraints = {}
+        parts = []
         for index, pattern_part in enumerate(pattern_tokens):
             prefix, pattern_part = _clear_name_by_prefix(pattern_part)
+            group = ""
+            strings = None
+            if "=" in pattern_part:
+                # name=import / name=from|import
+                pattern_part, strings = pattern_part.split("=", 1)
+                if prefix or not pattern_part.isalpha():
+                    raise PatternError(
+                        "String constraints can only be used on single"
+                        f" tokens, not on {prefix}{pattern_part}."
+                    )
+                group = f"?P<c{index}>"
+                strings = frozenset(strings.split("|"))
+                constraints[f"c{index}"] = strings
+
+            if parts is not None:
+                if (
+                    prefix
+                    or not pattern_part.isalpha()
+                    or pattern_part in EXPANDS
+                ):
+                    parts = None
+                else:
+                    parts.append((pattern_part.upper(), strings))
+
+            if _is_required(prefix, pattern_part):
+                requires.add(pattern_part.upper())
+            if reach is not None:
+                part_reach = _get_reach(prefix, pattern_part)
+                reach = None if part_reach is None else reach + part_reach
             add_parenthesis = not (
                 pattern_part.startswith("(") and pattern_part.endswith(")")
             )
@@ -136,12 +385,23 @@ def pattern(*pattern_tokens):
                 template = rf"\s{pattern_part}"
 
             if add_parenthesis:
-                template = rf"({template}){prefix}"
+                template = rf"({group}{template}){prefix}"
+            elif index == 0:
+                template = rf"{template}{prefix}"
             else:
                 template = rf"\s{template}{prefix}"
 
             pattern_template_buffer += template
-        pattern_template = re.compile(pattern_template_buffer, re.I)
+        # matches should always end on a token boundary
+        pattern_template_buffer += r"(?=\s|$)"
+        pattern_template = Pattern(
+            re.compile(pattern_template_buffer, re.I),
+            reach,
+            anchor,
+            frozenset(requires),
+            constraints,
+            parts and tuple(parts),
+        )
 
         if hasattr(func, "patterns"):
             func.patterns.append(pattern_template)
@@ -152,27 +412,384 @@ def pattern(*pattern_tokens):
     return wrapper
 
 
+class Placeholder:
+    def __init__(self, name, start, end):
+        self.name = name
+        self.start = start
+        self.end = end
+
+
+class TokenTemplate:
+    # Tokens of a source snippet (relative to (1, 0)) where the {name}
+    # parts are placeholders that are filled by substitute().
+    def __init__(self, stream_tokens):
+        self.parts = []
+        index = 0
+        while index < len(stream_tokens):
+            window = stream_tokens[index : index + 3]
+            if (
+                len(window) == 3
+                and [part.string for part in window[::2]] == ["{", "}"]
+                and window[1].type == token.NAME
+                and window[0].end == window[1].start
+                and window[1].end == window[2].start
+            ):
+                self.parts.append(
+                    Placeholder(
+                        window[1].string, window[0].start, window[2].end
+                    )
+                )
+                index += 3
+            else:
+                self.parts.append(stream_tokens[index])
+                index += 1
+
+    @staticmethod
+    def _move(stream_token, row_offset, column_offset):
+        (start_row, start_column), (end_row, end_column) = (
+            stream_token.start,
+            stream_token.end,
+        )
+        return stream_token._replace(
+            start=(start_row + row_offset, start_column + column_offset),
+            end=(end_row + row_offset, end_column + column_offset),
+        )
+
+    def substitute(self, position, **fillers):
+        # Place the template at the given (row, column) position, and
+        # replace each placeholder with the given token(s).
+        row, column = position
+        stream_tokens = []
+        row_offset = row - 1
+        column_line, column_offset = 1, column
+
+        def get_offset(template_row):
+            if template_row == column_line:
+                return column_offset
+            return 0
+
+        for part in self.parts:
+            if not isinstance(part, Placeholder):
+                stream_tokens.append(
+                    self._move(part, row_offset, get_offset(part.start[0]))
+                )
+                continue
+
+            filler = fillers[part.name]
+            if isinstance(filler, tokenize.TokenInfo):
+                filler = [filler]
+
+            target_row = part.start[0] + row_offset
+            target_column = part.start[1] + get_offset(part.start[0])
+            if not filler:
+                column_line = part.end[0]
+                column_offset = target_column - part.end[1]
+                continue
+
+            first_row, first_column = filler[0].start
+            for filler_token in filler:
+                stream_tokens.append(
+                    self._move(
+                        filler_token,
+                        target_row - first_row,
+                        target_column - first_column
+                        if filler_token.start[0] == first_row
+                        else 0,
+                    )
+                )
+
+            last_row, last_column = stream_tokens[-1].end
+            row_offset = last_row - part.end[0]
+            column_line = part.end[0]
+            column_offset = last_column - part.end[1]
+
+        return stream_tokens
+
+
+class ReferenceEngine:
+    # Matches the patterns' regexes on the text of the token names. Other
+    # engines subclass it (and can fall back to it for some patterns).
+    #
+    # find_matches() lazily yields the candidate matches (pattern by
+    # pattern). If regions are given, only the matches that touch one of
+    # them (the token ranges rewritten in the previous round) are yielded.
+    # If pattern_ids are given, only the patterns at these indexes are
+    # tried.
+    def find_matches(
+        self,
+        transformer,
+        patterns,
+        stream_tokens,
+        budget,
+        regions=None,
+        trace=None,
+        pattern_ids=None,
+    ):
+        stream_tokens_text, offsets = transformer._tokens_to_text(
+            stream_tokens
+        )
+        tried_patterns = [
+            pattern
+            for pattern_id, (pattern, _) in enumerate(patterns)
+            if pattern_ids is None or pattern_id in pattern_ids
+        ]
+        if any(pattern.anchor is not Anchor.ANY for pattern in tried_patterns):
+            anchors = transformer._get_anchors(stream_tokens)
+        if regions is not None:
+            region_starts = [region_start for region_start, _ in regions]
+
+        def touches_region(start, stop):
+            index = bisect.bisect_right(region_starts, stop) - 1
+            return index >= 0 and regions[index][1] >= start
+
+        if any(pattern.leading for pattern in tried_patterns):
+            string_positions = {}
+            for index, stream_token in enumerate(stream_tokens):
+                string_positions.setdefault(stream_token.string, []).append(
+                    index
+                )
+
+        def candidate_starts(pattern):
+            if pattern.leading:
+                # only try the positions where the first token's string is
+                # one of the allowed ones
+                positions = set()
+                for string in pattern.leading:
+                    positions.update(string_positions.get(string, ()))
+            else:
+                positions = range(len(offsets))
+
+            if pattern.anchor is not Anchor.ANY:
+                positions = [
+                    position
+                    for position in anchors[pattern.anchor]
+                    if position in positions
+                ]
+            elif pattern.leading:
+                positions = sorted(positions)
+
+            if regions is None:
+                return positions
+
+            starts = set()
+            for region_start, region_stop in regions:
+                if pattern.reach is None:
+                    lower = 0
+                else:
+                    lower = max(region_start - pattern.reach, 0)
+                upper = min(region_stop, len(offsets) - 1)
+                lower_index = bisect.bisect_left(positions, lower)
+                upper_index = bisect.bisect_right(positions, upper)
+                starts.update(positions[lower_index:upper_index])
+            return sorted(starts)
+
+        def satisfies_constraints(pattern, match):
+            for group, strings in pattern.constraints.items():
+                index = bisect.bisect_left(offsets, match.start(group))
+                if stream_tokens[index].string not in strings:
+                    return False
+            return True
+
+        if trace is not None:
+            trace.emit_tokens(stream_tokens)
+
+        for rank, (pattern, visitor) in enumerate(patterns):
+            if pattern_ids is not None and rank not in pattern_ids:
+                continue
+            pattern_id = rank
+            rank = (Priority.get(visitor), rank)
+            if trace is not None:
+                trace.emit(
+                    "pattern",
+                    pattern_id,
+                    pattern.regex.pattern,
+                    visitor.__name__,
+                )
+
+            for index in candidate_starts(pattern):
+                budget.attempt()
+                if trace is not None:
+                    trace.emit("attempt", pattern_id, index)
+                match = pattern.match(stream_tokens_text, offsets[index])
+                if match is None:
+                    continue
+                stop = bisect.bisect_left(offsets, match.end())
+                if (
+                    stop > index
+                    and (regions is None or touches_region(index, stop))
+                    and satisfies_constraints(pattern, match)
+                ):
+                    if trace is not None:
+                        trace.emit("match", pattern_id, index, stop)
+                    yield Match(index, stop, visitor, rank)
+
+
+class StepEngine(ReferenceEngine):
+    # Steps through the token types for the patterns that are plain
+    # sequences of token types (see Pattern.parts), and leaves the rest (and
+    # traced runs) to the reference engine.
+    def find_matches(
+        self,
+        transformer,
+        patterns,
+        stream_tokens,
+        budget,
+        regions=None,
+        trace=None,
+        pattern_ids=None,
+    ):
+        fallback_ids = set()
+        stepped = []
+        for pattern_id, (pattern, visitor) in enumerate(patterns):
+            if pattern_ids is not None and pattern_id not in pattern_ids:
+                continue
+            elif trace is None and pattern.parts:
+                stepped.append((pattern_id, pattern, visitor))
+            else:
+                fallback_ids.add(pattern_id)
+
+        if stepped:
+            yield from self._step_matches(
+                transformer, stepped, stream_tokens, budget, regions
+            )
+        if fallback_ids:
+            yield from super().find_matches(
+                transformer,
+                patterns,
+                stream_tokens,
+                budget,
+                regions,
+                trace,
+                fallback_ids,
+            )
+
+    def _step_matches(
+        self, transformer, stepped, stream_tokens, budget, regions
+    ):
+        types = [
+            transformer._get_type(stream_token)
+            for stream_token in stream_tokens
+        ]
+        size = len(types)
+        type_positions = {}
+        for index, toktype in enumerate(types):
+            type_positions.setdefault(toktype, []).append(index)
+        if any(pattern.anchor is not Anchor.ANY for _, pattern, _ in stepped):
+            anchors = {
+                anchor: set(positions)
+                for anchor, positions in transformer._get_anchors(
+                    stream_tokens
+                ).items()
+            }
+
+        for pattern_id, pattern, visitor in stepped:
+            rank = (Priority.get(visitor), pattern_id)
+            steps = []
+            for offset, (name, strings) in enumerate(pattern.parts):
+                toktype = getattr(token, name, None)
+                if token.tok_name.get(toktype) != name:
+                    # not a token type, the pattern can not match
+                    break
+                steps.append((offset, toktype, strings))
+            else:
+                length = len(steps)
+                # only the positions of the first token's type are tried
+                _, first_type, _ = steps[0]
+                positions = type_positions.get(first_type, [])
+                if regions is not None:
+                    # the matches that touch one of the regions
+                    windows = {
+                        position
+                        for region_start, region_stop in regions
+                        for position in range(
+                            max(region_start - length, 0), region_stop + 1
+                        )
+                    }
+                    positions = [
+                        position
+                        for position in positions
+                        if position in windows
+                    ]
+                if pattern.anchor is not Anchor.ANY:
+                    positions = [
+                        position
+                        for position in positions
+                        if position in anchors[pattern.anchor]
+                    ]
+
+                for index in positions:
+                    if index + length > size:
+                        break
+                    budget.attempt()
+                    for offset, toktype, strings in steps:
+                        if types[index + offset] != toktype or (
+                            strings is not None
+                            and stream_tokens[index + offset].string
+                            not in strings
+                        ):
+                            break
+                    else:
+                        yield Match(index, index + length, visitor, rank)
+
+
+DEFAULT_ENGINE = "reference"
+ENGINES = {"reference": ReferenceEngine(), "fast": StepEngine()}
+
+
+_TOKENIZE_LOCK = threading.RLock()
+
+
 class TokenTransformer:
     STRICT = True
+    CONFLICT_POLICY = "leftmost-longest"
+    FIXED_POINT = False
+    MAX_ITERATIONS = 16
+    # logical lines per window in transform_iter()
+    WINDOW = 1
+    # Matcher engine, a name from ENGINES or a ReferenceEngine instance
+    # (None => DEFAULT_ENGINE)
+    ENGINE = None
+
+    # Budgets (None => unlimited): wall time in seconds, pattern match
+    # attempts and output size as a multiple of the input token count.
+    MAX_TIME = None
+    MAX_ATTEMPTS = None
+    MAX_GROWTH = None
 
     def _next_token_slot(self):
         index = max(token.tok_name.keys(), default=0)
         return index + 1
 
     def _register_token(self, token_string, token_name):
+        token_index = getattr(token, token_name, None)
+        if (
+            token_index is not None
+            and token.EXACT_TOKEN_TYPES.get(token_string) == token_index
+        ):
+            # already registered (by a previous transform() call)
+            return
+
         token_index = self._next_token_slot()
         setattr(token, token_name, token_index)
         token.tok_name[token_index] = token_name
         token.EXACT_TOKEN_TYPES[token_string] = token_index
 
-    def _register_tokens(self):
-        escaped_tokens = []
+    def _get_tokens(self):
+        tokens = {}
         for name, member in inspect.getmembers(self):
             if name.startswith("register_"):
                 token_name = name.replace("register_", "", 1).upper()
-                token_string = member()
-                self._register_token(token_string, token_name)
-                escaped_tokens.append(re.escape(token_string))
+                tokens[token_name] = member()
+        return tokens
+
+    def _register_tokens(self):
+        self._install_tokens(self._get_tokens())
+
+    def _install_tokens(self, tokens):
+        escaped_tokens = []
+        for token_name, token_string in tokens.items():
+            self._register_token(token_string, token_name)
+            escaped_tokens.append(re.escape(token_string))
 
         tokenize.PseudoToken = tokenize.Whitespace + tokenize.group(
             *escaped_tokens,
@@ -184,11 +801,11 @@ class TokenTransformer:
         )
 
     def _pattern_search(self):
-        patterns = {}
+        patterns = []
         for name, member in inspect.getmembers(self):
             if hasattr(member, "patterns"):
                 for pattern in member.patterns:
-                    patterns[pattern] = member
+                    patterns.append((pattern, member))
         return patterns
 
     def _get_type(self, stream_token):
@@ -201,165 +818,369 @@ class TokenTransformer:
     def _get_name(self, stream_token):
         return token.tok_name[self._get_type(stream_token)]
 
-    def _slice_replace(self, visitor, pattern_slices, stream_tokens):
+    def _tokens_to_text(self, stream_tokens):
+        names = [
+            self._get_name(stream_token) for stream_token in stream_tokens
+        ]
+        offsets = []
         offset = 0
-        state = True
-        for pattern_slice in pattern_slices:
-            pattern_slice.increase(offset)
-            matching_tokens = stream_tokens[pattern_slice.s]
-            try:
-                tokens = visitor(*matching_tokens)
-                if tokens is None or tokens == matching_tokens:
-                    state = False
-                    tokens = matching_tokens
-                tokens, matching_tokens, stream_tokens = self.set_tokens(
-                    tokens, pattern_slice.s, matching_tokens, stream_tokens
-                )
-            except NoLineTransposer:
-                tokens = []
-                stream_tokens = self.shift_after(
-                    pattern_slice.s.stop, stream_tokens, y_offset=-1
-                )
+        for name in names:
+            offsets.append(offset)
+            offset += len(name) + 1  # filler (\s)
+        return " ".join(names), offsets
+
+    def _get_anchors(self, stream_tokens):
+        line_starts, block_starts = [0], []
+        depth = 0
+        for index, stream_token in enumerate(stream_tokens, 1):
+            toktype = self._get_type(stream_token)
+            if toktype in {token.LPAR, token.LSQB, token.LBRACE}:
+                depth += 1
+            elif toktype in {token.RPAR, token.RSQB, token.RBRACE}:
+                depth = max(depth - 1, 0)
+            elif toktype in {token.INDENT, token.DEDENT}:
+                line_starts.append(index)
+                block_starts.append(index)
+            elif toktype == token.NEWLINE or (
+                toktype == token.NL and depth == 0
+            ):
+                line_starts.append(index)
+        return {Anchor.LINE: line_starts, Anchor.BLOCK: block_starts}
+
+    def _resolve_matches(self, matches, stream_tokens, budget, trace=None):
+        policy = self.CONFLICT_POLICY
+        if inspect.ismethod(policy):
+            # user supplied policies are plain functions set on the class
+            policy = policy.__func__
+        policy = CONFLICT_POLICIES.get(policy, policy)
+        if not callable(policy):
+            raise PatternError(f"Unknown conflict policy, {policy!r}.")
+
+        matches = sorted(matches, key=policy)
+        intervals = Intervals()
+        replacements = []
+        for cancel_pending in (True, False):
+            if replacements:
+                # a CANCEL_PENDING visitor rewrote something, so the
+                # rest of the patterns are cancelled
+                break
+            for match in matches:
+                priority = Priority.get(match.visitor)
+                if (priority is Priority.CANCEL_PENDING) is not cancel_pending:
+                    continue
+                if intervals.overlaps(match.start, match.stop):
+                    continue
+
+                budget.check_time()
+                matching_tokens = stream_tokens[match.s]
+                try:
+                    tokens = match.visitor(*matching_tokens)
+                except NoLineTransposer:
+                    tokens = None
+                else:
+                    if tokens is None or list(tokens) == matching_tokens:
+                        continue
+                    tokens = list(tokens)
+
+                intervals.add(match.start, match.stop)
+                replacements.append((match.start, match.stop, tokens))
+                if trace is not None:
+                    trace.emit(
+                        "replace",
+                        match.start,
+                        match.stop,
+                        tokens and trace.dump_tokens(tokens),
+                    )
 
-            offset += len(tokens) - len(matching_tokens)
-            stream_tokens[pattern_slice.s] = tokens
+        replacements.sort(key=lambda replacement: replacement[0])
+        return replacements
 
-        return stream_tokens, state
+    def _batch_replace(self, replacements, stream_tokens, budget):
+        # Apply all (start, stop, tokens) replacements in a single pass.
+        # Line shifts (from NoLineTransposer) and column shifts (from single
+        # line rewrites) are accumulated and applied to the following tokens
+        # instead of re-positioning the whole stream after each rewrite.
+        new_tokens = []
+        regions = []
+        cursor = 0
+        y_offset = 0
+        x_offset, x_offset_line = 0, None
+
+        def adjust(stream_token):
+            if stream_token.start[0] == x_offset_line:
+                stream_token = self.increase(
+                    stream_token, amount=x_offset, page=1
+                )
+            if y_offset:
+                stream_token = self.increase(
+                    stream_token, amount=y_offset, page=0
+                )
+            return stream_token
 
-    def _pattern_transformer_regex(self, patterns, stream_tokens):
-        def token_to_text(stream_tokens):
-            return " ".join(
-                self._get_name(stream_token) for stream_token in stream_tokens
+        for start, stop, tokens in replacements:
+            new_tokens.extend(map(adjust, stream_tokens[cursor:start]))
+            budget.grow(new_tokens)
+            regions.append(
+                (len(new_tokens), len(new_tokens) + len(tokens or ()))
             )
+            cursor = stop
+            if tokens is None:
+                y_offset -= 1
+                continue
+            elif not tokens:
+                continue
 
-        def finditer_overlapping(pattern, text):
-            for counter in range(len(text)):
-                match = pattern.match(text, counter)
-                if match:
-                    yield match
-
-        def text_stream_searcher(start, end):
-            matchings = []
-            for (
-                stream_tokens_position,
-                index,
-            ) in stream_tokens_positions.items():
-                if (
-                    stream_tokens_position.start >= start
-                    and stream_tokens_position.end <= end
-                ):
-                    matchings.append(index)
-            try:
-                return (
-                    matchings[0],
-                    matchings[-1] + 1,
-                )  # hacky thing that make this work, please fix it ASAP
-            except IndexError:
-                return
-
-        def stream_tokens_reindex():
-            stream_tokens_positions.clear()
-            offset = 0
-            for index, stream_token_text in enumerate(
-                stream_tokens_text.split()
-            ):
-                stream_token_text_length = len(stream_token_text)
-                stream_tokens_positions[
-                    TextStreamTokenPosition(
-                        offset, offset + stream_token_text_length
-                    )
-                ] = index
-                offset += stream_token_text_length + 1  # filler (\s)
-
-        stream_tokens_text = token_to_text(stream_tokens)
-        stream_tokens_positions = {}
-        stream_tokens_reindex()
-        patterns = sorted(
-            patterns.items(),
-            key=lambda kv: Priority.get(kv[1]),
-        )
-
-        only_high = False
-        for pattern, visitor in patterns:
-            if (
-                only_high
-                and Priority.get(visitor) is not Priority.CANCEL_PENDING
+            matching_tokens = [
+                adjust(stream_token)
+                for stream_token in stream_tokens[start:stop]
+            ]
+            new_start, new_end = tokens[0], tokens[-1]
+            original_start = matching_tokens[0]
+            original_end = matching_tokens[-1]
+            if (new_start.start[0] != new_end.end[0]) or (
+                original_start.start[0] != original_end.end[0]
             ):
+                new_tokens.extend(map(adjust, tokens))
                 continue
 
-            slices = []
-            for match in finditer_overlapping(pattern, stream_tokens_text):
-                result = text_stream_searcher(*match.span())
-                if result:
-                    start_index, end_index = result
-                    slices.append(Slice(start_index, end_index))
-
-            stream_tokens, state = self._slice_replace(
-                visitor, slices, stream_tokens
+            tokens = self.shift_all(
+                tokens,
+                x_offset=original_start.start[1] - new_start.start[1],
+                y_offset=original_start.start[0] - new_start.start[0],
             )
-            stream_tokens_text = token_to_text(stream_tokens)
-            stream_tokens_reindex()
-
-            if Priority.get(visitor) is Priority.CANCEL_PENDING and state:
-                only_high = True
-            have_match = False
+            new_tokens.extend(tokens)
+            # keep the gap between the rewritten tokens and the rest of line
+            line = stream_tokens[start].start[0]
+            if line != x_offset_line:
+                x_offset, x_offset_line = 0, line
+            x_offset += tokens[-1].end[1] - original_end.end[1]
+
+        new_tokens.extend(map(adjust, stream_tokens[cursor:]))
+        budget.grow(new_tokens)
+        return new_tokens, regions
+
+    def _pattern_transformer_regex(
+        self, patterns, stream_tokens, budget, regions=None, trace=None
+    ):
+        matches = list(
+            self._find_matches(
+                patterns, stream_tokens, budget, regions=regions, trace=trace
+            )
+        )
+        replacements = self._resolve_matches(
+            matches, stream_tokens, budget, trace
+        )
+        return self._batch_replace(replacements, stream_tokens, budget)
+
+    def _get_engine(self):
+        engine = self.ENGINE or DEFAULT_ENGINE
+        engine = ENGINES.get(engine, engine)
+        if not isinstance(engine, ReferenceEngine):
+            raise PatternError(f"Unknown matcher engine, {engine!r}.")
+        return engine
+
+    def _find_matches(
+        self,
+        patterns,
+        stream_tokens,
+        budget,
+        regions=None,
+        trace=None,
+        pattern_ids=None,
+    ):
+        return self._get_engine().find_matches(
+            self, patterns, stream_tokens, budget, regions, trace, pattern_ids
+        )
 
+    def _apply_patterns(self, patterns, stream_tokens, budget, trace=None):
+        stream_tokens, regions = self._pattern_transformer_regex(
+            patterns, stream_tokens, budget, trace=trace
+        )
+        if self.FIXED_POINT:
+            # re-apply the patterns until nothing changes, but only around
+            # the regions that were rewritten in the previous round
+            for _ in range(self.MAX_ITERATIONS - 1):
+                if not regions:
+                    break
+                stream_tokens, regions = self._pattern_transformer_regex(
+                    patterns,
+                    stream_tokens,
+                    budget,
+                    regions=regions,
+                    trace=trace,
+                )
         return stream_tokens
 
-    def _pattern_transformer(self, patterns, stream_tokens):
-        for pattern, visitor in patterns.items():
-            start_indexes, end_indexes = [], []
-            pattern_state = 0
-
-            for token_index, stream_token in enumerate(stream_tokens):
-                if pattern_state == len(pattern):
-                    pattern_state = 0
-                    end_indexes.append(token_index)
-                if self._get_type(stream_token) == int(pattern[pattern_state]):
-                    if pattern_state == 0:
-                        start_indexes.append(token_index)
-                    pattern_state += 1
-                elif pattern_state != 0:
-                    pattern_state = 0
-                    start_indexes.pop()
-            else:
-                if pattern_state != 0:
-                    start_indexes.pop()
-
-            slices = [
-                Slice(start, end)
-                for start, end in zip(start_indexes, end_indexes)
-            ]
+    def _tokenize(self, source):
+        readline = io.StringIO(source).readline
+        with _TOKENIZE_LOCK:
+            # the registered tokens are patched into the global tokenizer
+            self._register_tokens()
+            return tuple(tokenize.generate_tokens(readline))
+
+    def _visit_tokens(self, stream_tokens, trace=None):
+        # Yield (index, new_token, visitor) for each token that a visitor
+        # returned a replacement for. The token types that have a batched
+        # visitor (visit_all_<type>(tokens, indexes)) are collected and
+        # passed to it at once, after the per-token visitors. It returns
+        # either a list of replacements (None => keep the token) or a
+        # mapping of index => replacement.
+        batched_visitors = {}
+        for name, member in inspect.getmembers(self):
+            if name.startswith("visit_all_"):
+                token_name = name.replace("visit_all_", "", 1).upper()
+                batched_visitors[token_name] = member
+        batches = {name: [] for name in batched_visitors}
 
-            stream_tokens = self._slice_replace(visitor, slices, stream_tokens)
+        for index, stream_token in enumerate(stream_tokens):
+            name = tokenize.tok_name[self._get_type(stream_token)]
+            if name in batches:
+                batches[name].append(index)
+                continue
+            visitor = getattr(self, f"visit_{name.lower()}", self.dummy)
+            new_token = visitor(stream_token)
+            if trace is not None:
+                trace.emit("visit", index, name)
+            if new_token is not None:
+                yield index, new_token, visitor
+
+        for name, indexes in batches.items():
+            if not indexes:
+                continue
+            visitor = batched_visitors[name]
+            new_tokens = visitor(
+                [stream_tokens[index] for index in indexes], indexes
+            )
+            if trace is not None:
+                for index in indexes:
+                    trace.emit("visit", index, name)
+            if new_tokens is None:
+                continue
+            elif not isinstance(new_tokens, dict):
+                new_tokens = dict(zip(indexes, new_tokens))
+            for index, new_token in sorted(new_tokens.items()):
+                if new_token is not None:
+                    yield index, new_token, visitor
+
+    def first_match(self, source):
+        # Return the first Match that would make transform() change the
+        # source (or None), without building the output. The visitors are
+        # still called, so they should not have side effects.
+        patterns = self._pattern_search()
+        budget = self._new_budget()
+        stream_tokens = self._tokenize(source)
+        budget.start(stream_tokens)
+
+        for index, new_token, visitor in self._visit_tokens(stream_tokens):
+            if new_token != stream_tokens[index]:
+                return Match(index, index + 1, visitor, None)
+        budget.check_time()
+
+        # Any accepted candidate means that at least one rewrite happens
+        # (either it, or an overlapping one that precedes it), so there is
+        # no need to resolve the conflicts.
+        for match in self._find_matches(patterns, stream_tokens, budget):
+            budget.check_time()
+            matching_tokens = list(stream_tokens[match.s])
+            try:
+                tokens = match.visitor(*matching_tokens)
+            except NoLineTransposer:
+                return match
+            if tokens is not None and list(tokens) != matching_tokens:
+                return match
+        return None
 
-        return stream_tokens
+    def matches(self, source):
+        return self.first_match(source) is not None
 
-    def transform(self, source, strictness=False):
-        self._register_tokens()
+    def transform(self, source, strictness=False, trace=None):
+        # If trace is given (a writable text stream), the events of this
+        # transform are recorded into it (see Trace).
         patterns = self._pattern_search()
+        budget = self._new_budget()
+        if trace is not None:
+            trace = Trace(trace)
 
-        readline = io.StringIO(source).readline
-        stream_tokens = tuple(tokenize.generate_tokens(readline))
-        stream_tokens_buffer = []
+        stream_tokens = self._tokenize(source)
+        budget.start(stream_tokens)
+        if trace is not None:
+            trace.emit_tokens(stream_tokens)
 
-        for stream_token in stream_tokens:
-            name = tokenize.tok_name[self._get_type(stream_token)]
-            visitor = getattr(self, f"visit_{name.lower()}", self.dummy)
-            stream_tokens_buffer.append(visitor(stream_token) or stream_token)
-
-        stream_tokens_buffer = self._pattern_transformer_regex(
-            patterns, stream_tokens_buffer
+        stream_tokens = self._transform_tokens(
+            patterns, stream_tokens, budget, trace
         )
-        stream_tokens = stream_tokens_buffer.copy()
+        return self._untokenize(tokenize.untokenize, stream_tokens, strictness)
+
+    def transform_iter(self, readline, strictness=False):
+        # Like transform(), but the tokens are pulled lazily from readline
+        # and transformed in windows of WINDOW logical lines (so patterns
+        # can not match across them), and the output is yielded line by line.
+        patterns = self._pattern_search()
+        budget = self._new_budget()
+        tokens = self._get_tokens()
+        token_stream = tokenize.generate_tokens(readline)
+        indents = []
+        while True:
+            window = []
+            lines = 0
+            with _TOKENIZE_LOCK:
+                self._install_tokens(tokens)
+                for stream_token in token_stream:
+                    window.append(stream_token)
+                    if stream_token.type == token.NEWLINE:
+                        lines += 1
+                        if lines >= self.WINDOW:
+                            break
+            if not window:
+                return
+
+            budget.start(window)
+            window = self._transform_tokens(patterns, window, budget)
+            if not window:
+                continue
+            source = self._untokenize(
+                partial(self._untokenize_window, indents=indents),
+                window,
+                strictness,
+            )
+            for stream_token in window:
+                if stream_token.type == token.INDENT:
+                    indents.append(stream_token)
+                elif stream_token.type == token.DEDENT and indents:
+                    indents.pop()
+            yield from source.splitlines(True)
+
+    def _transform_tokens(self, patterns, stream_tokens, budget, trace=None):
+        stream_tokens = self._apply_visitors(stream_tokens, trace)
+        budget.check_time()
+        return self._apply_patterns(patterns, stream_tokens, budget, trace)
+
+    def _apply_visitors(self, stream_tokens, trace=None):
+        stream_tokens_buffer = list(stream_tokens)
+        for index, new_token, _ in self._visit_tokens(stream_tokens, trace):
+            stream_tokens_buffer[index] = new_token
+        return stream_tokens_buffer
+
+    def _untokenize(self, untokenize, stream_tokens, strictness=False):
         try:
-            source = tokenize.untokenize(stream_tokens)
+            return untokenize(stream_tokens)
         except ValueError:
             if strictness or self.STRICT:
                 raise
             else:
-                source = self.quick_untokenize(stream_tokens)
-        return source
+                return self.quick_untokenize(stream_tokens)
+
+    def _untokenize_window(self, stream_tokens, indents):
+        # The window is untokenized as if it was following a newline with
+        # the currently open indents, which are then stripped.
+        row = stream_tokens[0].start[0] - 1
+        newline = tokenize.TokenInfo(
+            token.NEWLINE, "\n", (row, 0), (row, 1), "\n"
+        )
+        untokenizer = tokenize.Untokenizer()
+        untokenizer.prev_row, untokenizer.prev_col = newline.start
+        source = untokenizer.untokenize([*indents, newline, *stream_tokens])
+        return source[len(newline.string) :]
 
     def set_tokens(self, new_tokens, pattern, matching_tokens, all_tokens):
         new_start, new_end = new_tokens[0], new_tokens[-1]
@@ -434,6 +1255,23 @@ class TokenTransformer:
             token_stream = token_stream[:-2]
         return token_stream
 
+    def template(self, source):
+        # Tokenized once per class, see TokenTemplate.substitute()
+        templates = type(self).__dict__.get("_templates")
+        if templates is None:
+            templates = type(self)._templates = {}
+
+        if source not in templates:
+            stream_tokens = self.quick_tokenize(source, strip=False)
+            while stream_tokens and (
+                stream_tokens[-1].type in {token.ENDMARKER, token.DEDENT}
+                or stream_tokens[-1].type == token.NEWLINE
+                and not stream_tokens[-1].string
+            ):
+                stream_tokens.pop()
+            templates[source] = TokenTemplate(stream_tokens)
+        return templates[source]
+
     def quick_untokenize(self, tokens):
         return tokenize.untokenize(
             (token.type, token.string) for token in tokens
@@ -451,64 +1289,1641 @@ class TokenTransformer:
         # Implement dummy on subclasses for logging purposes or getting all tokens
         return None
 
+    def _has_dummy(self):
+        return type(self).dummy is not TokenTransformer.dummy
 
-def get_transformer_modules():
+    def _new_budget(self):
+        return Budget(self.MAX_TIME, self.MAX_ATTEMPTS, self.MAX_GROWTH)
+
+
+def _get_transformer_paths():
+    # the generated modules (see compile_transformer) are not transformers
     for path in TRANSFORMER_PATH.glob("**/*.py"):
-        spec = importlib.util.spec_from_file_location(path.stem, path)
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
-        yield module
+        if COMPILED_PATH not in path.parents:
+            yield path
+
+
+def get_transformer_modules():
+    for path in _get_transformer_paths():
+        yield _import_transformer_module(path)
+
+
+def _import_transformer_module(path):
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _get_transformer_classes(module):
+    for entry, possible_transformer in vars(module).items():
+        if (
+            isinstance(possible_transformer, type)
+            and issubclass(possible_transformer, TokenTransformer)
+            and possible_transformer is not TokenTransformer
+        ):
+            yield entry, possible_transformer
+
 
+def _is_selected(path, name, selection):
+    # transformers can be selected either by their module's or class' name
+    return selection is None or bool(
+        {Path(path).stem.lower(), name.lower()} & selection
+    )
+
+
+def get_transformers(source=None, selection=None, manifest=None):
+    # If the source is given, only the transformers that the manifest
+    # reports as relevant to it are imported (and instantiated).
+    if source is not None:
+        for path, name in _get_relevant_transformers(
+            source, selection, manifest
+        ):
+            module = _load_transformer_module(path)
+            yield _get_compiled_transformer(
+                path, name, getattr(module, name)
+            )()
+        return
 
-def get_transformers():
     for module in get_transformer_modules():
-        for entry, possible_transformer in vars(module).items():
+        for name, transformer in _get_transformer_classes(module):
+            if _is_selected(module.__file__, name, selection):
+                yield _get_compiled_transformer(
+                    module.__file__, name, transformer
+                )()
+
+
+def _describe_transformer(name, transformer):
+    tokens = {}
+    requirements = []
+    for member_name, member in inspect.getmembers(transformer):
+        if member_name.startswith("register_"):
+            token_name = member_name.replace("register_", "", 1).upper()
+            tokens[token_name] = member()
+        elif member_name.startswith("visit_all_"):
+            token_name = member_name.replace("visit_all_", "", 1).upper()
+            requirements.append([token_name])
+        elif member_name.startswith("visit_"):
+            token_name = member_name.replace("visit_", "", 1).upper()
+            requirements.append([token_name])
+
+    triggers = set(tokens.values())
+    for pattern, visitor in transformer._pattern_search():
+        requirement = set(pattern.requires)
+        for strings in pattern.constraints.values():
+            triggers.update(strings)
+            requirement.add("|".join(sorted(strings)).join("[]"))
+        requirements.append(sorted(requirement))
+
+    return {
+        "name": name,
+        "tokens": tokens,
+        "triggers": sorted(triggers),
+        "requirements": requirements,
+        # dummy() sees every token, and a pattern without any required
+        # token types might match anything
+        "always": transformer._has_dummy() or [] in requirements,
+    }
+
+
+def _describe_module(path):
+    content = path.read_bytes()
+    entry = {
+        "path": str(path),
+        "mtime": path.stat().st_mtime_ns,
+        "hash": hashlib.sha256(content).hexdigest(),
+        "transformers": [],
+    }
+    try:
+        module = _import_transformer_module(path)
+        for name, transformer in _get_transformer_classes(module):
+            entry["transformers"].append(
+                _describe_transformer(name, transformer())
+            )
+    except Exception as exc:
+        print(exc)
+        entry["error"] = str(exc)
+    return entry
+
+
+def build_manifest(manifest=None):
+    known_modules = {}
+    if manifest is not None:
+        known_modules = {
+            module["hash"]: module for module in manifest["modules"]
+        }
+
+    modules = []
+    for path in sorted(_get_transformer_paths()):
+        content_hash = hashlib.sha256(path.read_bytes()).hexdigest()
+        if content_hash in known_modules:
+            # only the mtime is changed, no need to execute it again
+            module = dict(known_modules[content_hash], path=str(path))
+            module["mtime"] = path.stat().st_mtime_ns
+        else:
+            module = _describe_module(path)
+        modules.append(module)
+
+    manifest = {"version": MANIFEST_VERSION, "modules": modules}
+    descriptor, temporary_path = tempfile.mkstemp(
+        prefix=f"{MANIFEST_PATH.name}.", dir=MANIFEST_PATH.parent
+    )
+    try:
+        with open(descriptor, "w") as stream:
+            json.dump(manifest, stream, indent=4)
+        os.replace(temporary_path, MANIFEST_PATH)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+    return manifest
+
+
+# (manifest path, its mtime, the transformer mtimes), manifest
+_LOADED_MANIFEST = None
+# serializes the rebuilds of the manifest
+_MANIFEST_LOCK = threading.RLock()
+
+
+def _get_manifest_stamp():
+    try:
+        return MANIFEST_PATH.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _get_manifest_key():
+    stamps = {
+        str(path): path.stat().st_mtime_ns for path in _get_transformer_paths()
+    }
+    return MANIFEST_PATH, _get_manifest_stamp(), stamps
+
+
+def load_manifest():
+    global _LOADED_MANIFEST
+    # the manifest is only parsed again when it or a transformer changes
+    key = _get_manifest_key()
+    loaded_manifest = _LOADED_MANIFEST
+    if loaded_manifest is not None and loaded_manifest[0] == key:
+        return loaded_manifest[1]
+
+    with _MANIFEST_LOCK:
+        # another thread may have loaded (or rebuilt) it in the meantime
+        key = _get_manifest_key()
+        loaded_manifest = _LOADED_MANIFEST
+        if loaded_manifest is not None and loaded_manifest[0] == key:
+            return loaded_manifest[1]
+
+        try:
+            with open(MANIFEST_PATH) as stream:
+                manifest = json.load(stream)
+        except (OSError, ValueError):
+            manifest = None
+
+        _, _, stamps = key
+        if (
+            manifest is None
+            or manifest.get("version") != MANIFEST_VERSION
+            or stamps
+            != {
+                module["path"]: module["mtime"]
+                for module in manifest["modules"]
+            }
+        ):
+            manifest = build_manifest(manifest)
+            key = _get_manifest_key()
+        _LOADED_MANIFEST = key, manifest
+    return manifest
+
+
+_TRANSFORMER_MODULES = {}
+_TRANSFORMER_MODULES_LOCK = threading.Lock()
+
+
+def _load_transformer_module(path):
+    key = (path, os.stat(path).st_mtime_ns)
+    with _TRANSFORMER_MODULES_LOCK:
+        if key not in _TRANSFORMER_MODULES:
+            _TRANSFORMER_MODULES[key] = _import_transformer_module(Path(path))
+    return _TRANSFORMER_MODULES[key]
+
+
+def _get_compiled_path(path, name):
+    return COMPILED_PATH / f"{Path(path).stem}__{name}.py"
+
+
+_COMPILED_TRANSFORMERS = {}
+
+
+def _get_compiled_transformer(path, name, transformer):
+    # Return the specialized version of the transformer class if it was
+    # compiled from the current source of its module.
+    compiled_path = _get_compiled_path(path, name)
+    try:
+        key = (transformer, compiled_path.stat().st_mtime_ns)
+    except FileNotFoundError:
+        return transformer
+
+    with _TRANSFORMER_MODULES_LOCK:
+        if key not in _COMPILED_TRANSFORMERS:
+            module = _import_transformer_module(compiled_path)
             if (
-                isinstance(possible_transformer, type)
-                and issubclass(possible_transformer, TokenTransformer)
-                and possible_transformer is not TokenTransformer
+                module.COMPILED_VERSION == COMPILED_VERSION
+                and module.SOURCE_HASH == _hash_file(Path(path))
+            ):
+                _COMPILED_TRANSFORMERS[key] = module.specialize(transformer)
+            else:
+                _COMPILED_TRANSFORMERS[key] = transformer
+    return _COMPILED_TRANSFORMERS[key]
+
+
+def _get_visitor_dispatch(name, tokens):
+    # How the generated code recognizes the tokens of a visitor: either by
+    # their exact string or by their (non-exact) type.
+    if name in tokens:
+        return "string", tokens[name]
+    toktype = getattr(token, name, None)
+    if not isinstance(toktype, int) or token.tok_name.get(toktype) != name:
+        return None
+    elif toktype in token.EXACT_TOKEN_NAMES:
+        return "string", token.EXACT_TOKEN_NAMES[toktype]
+    return "type", name
+
+
+def _generate_visit_tokens(transformer, tokens):
+    if transformer._has_dummy():
+        return []
+
+    dispatches = []
+    for member_name, member in inspect.getmembers(transformer):
+        if member_name.startswith("visit_all_"):
+            return []
+        elif member_name.startswith("visit_"):
+            name = member_name.replace("visit_", "", 1).upper()
+            dispatch = _get_visitor_dispatch(name, tokens)
+            if dispatch is None:
+                return []
+            dispatches.append((member_name, dispatch))
+    if not dispatches:
+        return []
+
+    lines = [
+        "def _visit_tokens(self, stream_tokens, trace=None):",
+        "    if trace is not None:",
+        "        yield from super()._visit_tokens(stream_tokens, trace)",
+        "        return",
+        "",
+        "    exact_types = token.EXACT_TOKEN_TYPES",
+    ]
+    for member_name, _ in dispatches:
+        lines.append(f"    {member_name} = self.{member_name}")
+    lines += [
+        "    for index, stream_token in enumerate(stream_tokens):",
+        "        string = stream_token.string",
+    ]
+    for index, (member_name, (kind, value)) in enumerate(dispatches):
+        keyword = "if" if index == 0 else "elif"
+        if kind == "string":
+            condition = f"string == {value!r}"
+        else:
+            condition = (
+                f"stream_token.type == token.{value}"
+                " and string not in exact_types"
+            )
+        lines += [
+            f"        {keyword} {condition}:",
+            f"            new_token = {member_name}(stream_token)",
+            "            if new_token is not None:",
+            f"                yield index, new_token, {member_name}",
+        ]
+    return lines
+
+
+def _generate_transformer_module(path, name, transformer):
+    transformer = transformer()
+    tokens = transformer._get_tokens()
+    patterns = transformer._pattern_search()
+
+    methods = [
+        "def _get_tokens(self):",
+        "    return TOKENS",
+        "",
+        "def _pattern_search(self):",
+        "    return [",
+    ]
+    for pattern, visitor in patterns:
+        method = f"self.{visitor.__name__}"
+        index = next(
+            index
+            for index, candidate in enumerate(visitor.patterns)
+            if candidate is pattern
+        )
+        methods.append(f"        ({method}.patterns[{index}], {method}),")
+    methods.append("    ]")
+    visit_tokens = _generate_visit_tokens(transformer, tokens)
+    if visit_tokens:
+        methods += ["", *visit_tokens]
+    if (
+        transformer.ENGINE is None
+        and patterns
+        and all(pattern.parts for pattern, _ in patterns)
+    ):
+        # every pattern is a plain sequence of token types, which the fast
+        # engine steps through without the regex search
+        methods = ['ENGINE = "fast"', "", *methods]
+
+    lines = [
+        "# Generated by `python -m brm compile-transformer` from",
+        f"# {path}, do not edit.",
+        "import token",
+        "",
+        f"SOURCE_HASH = {_hash_file(Path(path))!r}",
+        f"COMPILED_VERSION = {COMPILED_VERSION!r}",
+        f"TOKENS = {tokens!r}",
+        "",
+        "",
+        "def specialize(base):",
+        f"    class {name}(base):",
+    ]
+    for line in methods:
+        lines.append(f"        {line}" if line else "")
+    lines += ["", f"    return {name}", ""]
+    return "\n".join(lines)
+
+
+def compile_transformer(path, name):
+    # Generate a specialized version of the given transformer class, which
+    # get_transformers() prefers for as long as its module is not changed.
+    module = _import_transformer_module(Path(path))
+    compiled_path = _get_compiled_path(path, name)
+    COMPILED_PATH.mkdir(exist_ok=True)
+    temporary_path = compiled_path.with_name(
+        f"{compiled_path.name}.{os.getpid()}"
+    )
+    temporary_path.write_text(
+        _generate_transformer_module(path, name, getattr(module, name))
+    )
+    os.replace(temporary_path, compiled_path)
+    return compiled_path
+
+
+def _get_token_names(source):
+    try:
+        return {
+            token.tok_name[token.EXACT_TOKEN_TYPES.get(string, toktype)]
+            for toktype, string, *_ in tokenize.generate_tokens(
+                io.StringIO(source).readline
+            )
+        }
+    except (tokenize.TokenError, SyntaxError):
+        return None
+
+
+def _is_relevant(transformer, source, token_names):
+    if transformer["always"] or token_names is None:
+        return True
+
+    def is_present(name):
+        if name in transformer["tokens"]:
+            return transformer["tokens"][name] in source
+        elif name.startswith("["):
+            # [from|import] => one of these strings should be in the source
+            return any(string in source for string in name[1:-1].split("|"))
+        return name in token_names
+
+    return any(
+        all(map(is_present, requirement))
+        for requirement in transformer["requirements"]
+    )
+
+
+def _get_relevant_transformers(source, selection=None, manifest=None):
+    # Once a transformer is relevant, all the later ones are kept as well,
+    # since they may become relevant to its output.
+    if manifest is None:
+        manifest = load_manifest()
+    token_names = _get_token_names(source)
+    relevant = False
+    for module in manifest["modules"]:
+        for transformer in module["transformers"]:
+            if not _is_selected(
+                module["path"], transformer["name"], selection
             ):
-                yield possible_transformer()
+                continue
+            relevant = relevant or _is_relevant(
+                transformer, source, token_names
+            )
+            if relevant:
+                yield module["path"], transformer["name"]
+
+
+def _get_transformer_names():
+    names = set()
+    for module in load_manifest()["modules"]:
+        names.add(Path(module["path"]).stem.lower())
+        for transformer in module["transformers"]:
+            names.add(transformer["name"].lower())
+    return names
+
+
+def parse_encoding(name):
+    # brm, brm-utf8                      => all transformers
+    # brm.async_sugar.dollar_eq-utf8     => only the given transformers
+    #
+    # Python 3.9+ normalizes the names before passing them to search()
+    # (brm.foo.bar-utf8 => brm.foo.bar_utf8), so the underlying encoding
+    # is separated from the last transformer name by using the known
+    # transformer names.
+    name = name.lower()
+    if not name.startswith("brm"):
+        return None
 
+    rest = name[3:]
+    selection = None
+    if rest.startswith("."):
+        *names, last = rest[1:].split(".")
+        if "-" in last:
+            last, _, rest = last.partition("-")
+        else:
+            rest = ""
+            known_names = _get_transformer_names()
+            if last not in known_names:
+                for known_name in sorted(known_names, key=len, reverse=True):
+                    if last.startswith(f"{known_name}_"):
+                        last, rest = known_name, last[len(known_name) :]
+                        break
+        selection = frozenset(names + [last])
+
+    encoding = rest.lstrip("-_") or "utf8"
+    return encoding, selection
+
+
+def _check_selection(selection):
+    # otherwise a typo in the coding cookie would silently leave the file
+    # untransformed
+    if selection is not None:
+        unknown_names = selection - _get_transformer_names()
+        if unknown_names:
+            raise LookupError(
+                f"unknown brm transformers: {', '.join(sorted(unknown_names))}"
+            )
+
+
+def _transform_fused(transformers, source):
+    # Apply the transformers as if they were run one after another, but with
+    # a single tokenization and a single walk over the tokens for all their
+    # visitors (each token goes through the visitors of its type, in the
+    # order of the transformers), followed by the pattern phase of the last
+    # one. Return None if the transformers can not be fused, which is when
+    # any but the last one has patterns (as the visitors of the later ones
+    # have to see their output) or batched visitors.
+    if any(
+        transformer._pattern_search() for transformer in transformers[:-1]
+    ) or any(
+        name.startswith("visit_all_")
+        for transformer in transformers
+        for name in dir(transformer)
+    ):
+        return None
 
-def decode(input, errors="strict", encoding=None):
+    tokens = {}
+    for transformer in transformers:
+        tokens.update(transformer._get_tokens())
+    head = transformers[0]
+    readline = io.StringIO(source).readline
+    with _TOKENIZE_LOCK:
+        head._install_tokens(tokens)
+        stream_tokens = list(tokenize.generate_tokens(readline))
+
+    budgets = []
+    for transformer in transformers:
+        budget = transformer._new_budget()
+        budget.start(stream_tokens)
+        budgets.append(budget)
+
+    # token name => [(transformer index, visitor), ...]
+    dispatch = {}
+
+    def get_visitors(name):
+        if name not in dispatch:
+            dispatch[name] = []
+            for order, transformer in enumerate(transformers):
+                visitor = getattr(transformer, f"visit_{name.lower()}", None)
+                if visitor is None and transformer._has_dummy():
+                    visitor = transformer.dummy
+                if visitor is not None:
+                    dispatch[name].append((order, visitor))
+        return dispatch[name]
+
+    # each transformer with a time budget is only charged for the time of
+    # its own visitors in the shared walk
+    timed = [budget.max_time is not None for budget in budgets]
+    spent = [0.0] * len(transformers)
+    walk_started = time.perf_counter()
+    for index, stream_token in enumerate(stream_tokens):
+        name = head._get_name(stream_token)
+        order = 0
+        while True:
+            for visitor_order, visitor in get_visitors(name):
+                if visitor_order >= order:
+                    break
+            else:
+                break
+
+            if timed[visitor_order]:
+                visit_started = time.perf_counter()
+                new_token = visitor(stream_token)
+                spent[visitor_order] += time.perf_counter() - visit_started
+            else:
+                new_token = visitor(stream_token)
+            if new_token is not None and new_token != stream_token:
+                stream_token = new_token
+                name = head._get_name(stream_token)
+            order = visitor_order + 1
+        stream_tokens[index] = stream_token
+    walk_time = time.perf_counter() - walk_started
+
+    transformer = None
+    try:
+        for transformer, budget, own_time in zip(transformers, budgets, spent):
+            if budget.max_time is not None:
+                budget.exclude(walk_time - own_time)
+            budget.check_time()
+        stream_tokens = transformer._apply_patterns(
+            transformer._pattern_search(), stream_tokens, budget
+        )
+    except BudgetExceeded as exc:
+        # so that only this transformer is skipped (see decode())
+        exc.transformer = transformer
+        raise
+    return tokenize.untokenize(stream_tokens)
+
+
+DECODE_CACHE_SIZE = 128
+
+_DECODED = {}
+_DECODED_LOCK = threading.Lock()
+
+
+def _get_fingerprint(manifest):
+    fingerprint = hashlib.sha256()
+    for module in manifest["modules"]:
+        fingerprint.update(f"{module['path']}:{module['hash']}".encode())
+    return fingerprint.hexdigest()
+
+
+def _get_source_path():
+    # The path of the module that is being imported (if decode() is called
+    # while compiling it), see importlib's SourceLoader.source_to_code().
+    frame = sys._getframe(2)
+    while frame is not None:
+        if frame.f_code.co_name == "source_to_code":
+            path = frame.f_locals.get("path")
+            if isinstance(path, str):
+                return path
+        frame = frame.f_back
+    return None
+
+
+def _update_linecache(path, source):
+    # Later lookups (tracebacks, inspect.getsource) re-open the file through
+    # the codec, so store the transformed text as if linecache read it.
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    lines = source.splitlines(True)
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    linecache.cache[path] = (stat.st_size, stat.st_mtime, lines, path)
+
+
+def decode(input, errors="strict", encoding=None, selection=None):
+    started = time.perf_counter()
+    size = len(input)
     if not isinstance(input, str):
         input, _ = encoding.decode(input, errors)
 
-    for transformer in get_transformers():
-        try:
-            input = transformer.transform(input)
-        except Exception as exc:
-            print(exc)
-    return input, len(input)
+    # the same source is decoded again whenever linecache (or anything that
+    # uses tokenize.open) reads it, so the results are cached by the source
+    # and the installed transformers
+    manifest = load_manifest()
+    key = (
+        hashlib.sha256(input.encode("utf8", "surrogatepass")).digest(),
+        selection,
+        _get_fingerprint(manifest),
+    )
+    with _DECODED_LOCK:
+        cached_output = _DECODED.get(key)
+
+    output = cached_output
+    timings = {}
+    if output is None:
+        transformers = list(get_transformers(input, selection, manifest))
+        # profiled imports are not fused, to time each transformer
+        if len(transformers) > 1 and _PROFILE is None:
+            try:
+                output = _transform_fused(transformers, input)
+            except BudgetExceeded as exc:
+                # running it again would only exceed its budget again
+                warnings.warn(BudgetWarning(exc.transformer, exc))
+                transformers.remove(exc.transformer)
+            except Exception:
+                # the sequential path below reports the errors of each
+                # transformer
+                output = None
+
+    if output is None:
+        output = input
+        for transformer in transformers:
+            transformer_started = time.perf_counter()
+            try:
+                output = transformer.transform(output)
+            except BudgetExceeded as exc:
+                warnings.warn(BudgetWarning(transformer, exc))
+            except Exception as exc:
+                print(exc)
+            timings[type(transformer).__name__] = (
+                time.perf_counter() - transformer_started
+            )
+
+    if cached_output is None:
+        with _DECODED_LOCK:
+            _DECODED[key] = output
+            while len(_DECODED) > DECODE_CACHE_SIZE:
+                del _DECODED[next(iter(_DECODED))]
+
+    path = _get_source_path()
+    if path is not None:
+        _update_linecache(path, output)
+    if _PROFILE is not None:
+        _PROFILE.record(
+            path, input, size, time.perf_counter() - started, timings
+        )
+    return output, len(output)
 
 
 class IncrementalDecoder(codecs.BufferedIncrementalDecoder):
+    # each codec has its own subclass with these set (see get_codec())
+    _encoding = codecs.lookup("utf8")
+    _selection = None
+
     def _buffer_decode(self, input, errors, final):
-        return decode(input, errors, encoding=self._encoding)
+        return decode(
+            input, errors, encoding=self._encoding, selection=self._selection
+        )
+
+
+_CODECS = {}
+_CODECS_LOCK = threading.Lock()
+
+
+def get_codec(encoding, selection=None):
+    encoding = codecs.lookup(encoding)
+    key = (encoding.name, selection)
+    if key in _CODECS:
+        return _CODECS[key]
+
+    with _CODECS_LOCK:
+        if key not in _CODECS:
+            incremental_decoder = type(
+                "IncrementalDecoder",
+                (IncrementalDecoder,),
+                {"_encoding": encoding, "_selection": selection},
+            )
+            _CODECS[key] = codecs.CodecInfo(
+                name="brm",
+                encode=encoding.encode,
+                decode=partial(decode, encoding=encoding, selection=selection),
+                incrementalencoder=encoding.incrementalencoder,
+                incrementaldecoder=incremental_decoder,
+                streamreader=encoding.streamreader,
+                streamwriter=encoding.streamwriter,
+            )
+    return _CODECS[key]
 
 
 def search(name):
-    if "brm" in name:
-        encoding = name.strip("brm").strip("-") or "utf8"
-        encoding = codecs.lookup(encoding)
-        IncrementalDecoder._encoding = encoding
+    started = time.perf_counter()
+    try:
+        parsed_encoding = parse_encoding(name)
+        if parsed_encoding is not None:
+            _check_selection(parsed_encoding[1])
+            return get_codec(*parsed_encoding)
+    finally:
+        if _PROFILE is not None:
+            _PROFILE.lookup_time += time.perf_counter() - started
+
+
+_SEARCH_REGISTERED = False
+
+
+def _register_search():
+    # codecs can't tell whether a search function is already registered
+    # (or unregister one before 3.10), so it is only registered once
+    global _SEARCH_REGISTERED
+    if not _SEARCH_REGISTERED:
+        codecs.register(search)
+        _SEARCH_REGISTERED = True
+
+
+_PROFILE = None
+
+
+class ImportProfile:
+    # Collects the decode costs of the brm encoded modules while it is
+    # active (see profile_import).
+    def __init__(self):
+        self.modules = {}
+        self.lookup_time = 0.0
+        self.total_time = 0.0
+        # time spent on the profiling itself (counting tokens)
+        self.overhead = 0.0
+
+    def record(self, path, source, size, elapsed, timings):
+        started = time.perf_counter()
+        try:
+            tokens = sum(
+                1
+                for _ in tokenize.generate_tokens(io.StringIO(source).readline)
+            )
+        except (tokenize.TokenError, SyntaxError):
+            tokens = None
+
+        entry = self.modules.setdefault(
+            path,
+            {
+                "module": None,
+                "path": path,
+                "bytes": 0,
+                "tokens": 0,
+                "decode_time": 0.0,
+                "transformers": {},
+            },
+        )
+        entry["bytes"] += size
+        if tokens is not None and entry["tokens"] is not None:
+            entry["tokens"] += tokens
+        else:
+            entry["tokens"] = None
+        entry["decode_time"] += elapsed
+        for name, timing in timings.items():
+            entry["transformers"][name] = (
+                entry["transformers"].get(name, 0.0) + timing
+            )
+        self.overhead += time.perf_counter() - started
+
+    def report(self):
+        paths = {
+            getattr(module, "__file__", None): name
+            for name, module in list(sys.modules.items())
+        }
+        modules = sorted(
+            self.modules.values(),
+            key=lambda entry: entry["decode_time"],
+            reverse=True,
+        )
+        for entry in modules:
+            entry["module"] = paths.get(entry["path"])
+
+        decode_time = sum(entry["decode_time"] for entry in modules)
+        return {
+            "total_time": self.total_time,
+            "decode_time": decode_time,
+            "decode_share": decode_time / self.total_time
+            if self.total_time
+            else 0.0,
+            "lookup_time": self.lookup_time,
+            "modules": modules,
+        }
+
+    def format(self):
+        report = self.report()
+        lines = [f"{'decode (ms)':>12} {'bytes':>9} {'tokens':>9}  module"]
+        for entry in report["modules"]:
+            lines.append(
+                f"{entry['decode_time'] * 1000:12.2f}"
+                f" {entry['bytes']:9d} {entry['tokens'] or '-':>9}"
+                f"  {entry['module'] or entry['path'] or '<unknown>'}"
+            )
+            for name, timing in sorted(
+                entry["transformers"].items(),
+                key=lambda item: item[1],
+                reverse=True,
+            ):
+                lines.append(
+                    f"{timing * 1000:12.2f} {'':>9} {'':>9}    {name}"
+                )
+        lines.append(
+            f"decode: {report['decode_time'] * 1000:.2f}ms of"
+            f" {report['total_time'] * 1000:.2f}ms import time"
+            f" ({report['decode_share']:.1%}), codec lookups:"
+            f" {report['lookup_time'] * 1000:.2f}ms"
+        )
+        return "\n".join(lines)
+
+
+def profile_import(name):
+    # Import the module with the decode costs of the brm encoded modules
+    # recorded, and return the ImportProfile.
+    global _PROFILE
+    _register_search()
+    profile = ImportProfile()
+    _PROFILE = profile
+    started = time.perf_counter()
+    try:
+        importlib.import_module(name)
+    finally:
+        _PROFILE = None
+        profile.total_time = time.perf_counter() - started - profile.overhead
+    return profile
+
+
+class RemoteError(Exception):
+    pass
+
+
+def _send_message(connection, message):
+    payload = json.dumps(message).encode()
+    connection.sendall(struct.pack(">I", len(payload)) + payload)
+
+
+def _receive_exactly(connection, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = connection.recv(size - len(buffer))
+        if not chunk:
+            return None
+        buffer.extend(chunk)
+    return bytes(buffer)
+
 
-        brm_codec = codecs.CodecInfo(
-            name="brm",
-            encode=encoding.encode,
-            decode=partial(decode, encoding=encoding),
-            incrementalencoder=encoding.incrementalencoder,
-            incrementaldecoder=IncrementalDecoder,
-            streamreader=encoding.streamreader,
-            streamwriter=encoding.streamwriter,
+def _receive_message(connection):
+    # messages are length (4 bytes, big endian) prefixed JSON objects
+    header = _receive_exactly(connection, 4)
+    if header is None:
+        return None
+    (size,) = struct.unpack(">I", header)
+    payload = _receive_exactly(connection, size)
+    if payload is None:
+        return None
+    return json.loads(payload.decode())
+
+
+def _parse_selection(names):
+    if names is None:
+        return None
+    return frozenset(name.strip().lower() for name in names if name.strip())
+
+
+class _TransformHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            request = _receive_message(self.request)
+            if request is None:
+                break
+
+            try:
+                selection = _parse_selection(request.get("transformers"))
+                _check_selection(selection)
+                source, _ = decode(request["source"], selection=selection)
+            except Exception as exc:
+                response = {"error": f"{type(exc).__name__}: {exc}"}
+            else:
+                response = {"source": source}
+            _send_message(self.request, response)
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+
+    class TransformServer(socketserver.UnixStreamServer):
+        def __init__(self, path=SOCKET_PATH, workers=None):
+            self.executor = ThreadPoolExecutor(workers)
+            path = Path(path)
+            if path.exists():
+                path.unlink()
+            super().__init__(str(path), _TransformHandler)
+
+        def warm_up(self):
+            # import all the transformers (and register their tokens) once
+            for module in load_manifest()["modules"]:
+                if "error" in module:
+                    continue
+                transformer_module = _load_transformer_module(module["path"])
+                for transformer in module["transformers"]:
+                    transformer = getattr(
+                        transformer_module, transformer["name"]
+                    )
+                    with _TOKENIZE_LOCK:
+                        transformer()._register_tokens()
+
+        def process_request(self, request, client_address):
+            self.executor.submit(
+                self._process_request, request, client_address
+            )
+
+        def _process_request(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+        def server_close(self):
+            super().server_close()
+            self.executor.shutdown()
+            if os.path.exists(self.server_address):
+                os.unlink(self.server_address)
+
+
+def transform_remote(source, selection=None, path=SOCKET_PATH):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(str(path))
+        _send_message(
+            connection,
+            {
+                "source": source,
+                "transformers": selection and sorted(selection),
+            },
+        )
+        response = _receive_message(connection)
+
+    if response is None:
+        raise RemoteError("Connection closed by the server.")
+    elif "error" in response:
+        raise RemoteError(response["error"])
+    return response["source"]
+
+
+COOKIE_RE = re.compile(rb"^[ \t\f]*#.*?coding[:=][ \t]*([-\w.]+)")
+BLANK_RE = re.compile(rb"^[ \t\f]*(?:[#\r\n]|$)")
+
+
+def _find_coding_cookie(data):
+    # Return the (line, match) of the PEP 263 coding cookie in the first
+    # two lines of the given bytes.
+    lines = data.split(b"\n", 2)[:2]
+    for line_number, line in enumerate(lines):
+        match = COOKIE_RE.match(line)
+        if match:
+            return line_number, match
+        elif not BLANK_RE.match(line):
+            break
+    return None
+
+
+def transform_file(data):
+    # Transform the source (bytes) of a brm encoded file and replace its
+    # cookie with the underlying encoding, so the result can be imported
+    # without brm. Other sources are returned as is.
+    cookie = _find_coding_cookie(data)
+    if cookie is None:
+        return data
+
+    line_number, match = cookie
+    parsed_encoding = parse_encoding(match.group(1).decode("ascii"))
+    if parsed_encoding is None:
+        return data
+
+    encoding, selection = parsed_encoding
+    _check_selection(selection)
+    lines = data.split(b"\n", 2)
+    line = lines[line_number]
+    lines[line_number] = (
+        line[: match.start(1)]
+        + encoding.encode("ascii")
+        + line[match.end(1) :]
+    )
+    source, _ = decode(
+        b"\n".join(lines),
+        encoding=codecs.lookup(encoding),
+        selection=selection,
+    )
+    return source.encode(encoding)
+
+
+def _read_source(data):
+    # Decode the source (bytes) without running the brm codec on it.
+    cookie = _find_coding_cookie(data)
+    if cookie is not None:
+        _, match = cookie
+        parsed_encoding = parse_encoding(match.group(1).decode("ascii"))
+        if parsed_encoding is not None:
+            encoding, _ = parsed_encoding
+            return data.decode(encoding)
+
+    encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+    return data.decode(encoding)
+
+
+def find_matches(transformer, paths, workers=None):
+    # Yield (path, match) for each of the given files that would be changed
+    # by the transformer (see TokenTransformer.first_match).
+    def first_match(path):
+        return path, transformer.first_match(_read_source(path.read_bytes()))
+
+    paths = map(Path, paths)
+    if workers is None:
+        results = map(first_match, paths)
+    else:
+        executor = ThreadPoolExecutor(workers)
+        results = executor.map(first_match, paths)
+
+    try:
+        for path, match in results:
+            if match is not None:
+                yield path, match
+    finally:
+        if workers is not None:
+            executor.shutdown(wait=False)
+
+
+class TokenBuffer:
+    # A token stream encoded as flat binary data (which can be placed in
+    # shared memory and read by another process):
+    #   header: token count, string count
+    #   records: (type, string index, start row, start column, end row,
+    #            end column) as int32s for each token
+    #   string table: int32 offsets (string count + 1) into the UTF-8
+    #                 encoded text of all the distinct strings
+    # The tokens are read back with an empty line attribute.
+    HEADER = struct.Struct("<II")
+    FIELDS = 6
+
+    def __init__(self, buffer):
+        token_count, string_count = self.HEADER.unpack_from(buffer)
+        position = self.HEADER.size
+        self.records = array("i")
+        size = token_count * self.FIELDS * self.records.itemsize
+        self.records.frombytes(buffer[position : position + size])
+        position += size
+
+        offsets = array("i")
+        size = (string_count + 1) * offsets.itemsize
+        offsets.frombytes(buffer[position : position + size])
+        position += size
+        text = bytes(buffer[position : position + offsets[-1]])
+        self.strings = [
+            text[start:end].decode("utf8")
+            for start, end in zip(offsets, offsets[1:])
+        ]
+
+    @classmethod
+    def encode(cls, stream_tokens):
+        string_indexes = {}
+        records = array(
+            "i",
+            [
+                field
+                for toktype, string, start, end, _ in stream_tokens
+                for field in (
+                    toktype,
+                    string_indexes.setdefault(string, len(string_indexes)),
+                    *start,
+                    *end,
+                )
+            ],
+        )
+
+        offsets = array("i", [0])
+        texts = []
+        for string in string_indexes:
+            texts.append(string.encode("utf8"))
+            offsets.append(offsets[-1] + len(texts[-1]))
+        return b"".join(
+            [
+                cls.HEADER.pack(len(records) // cls.FIELDS, len(texts)),
+                records.tobytes(),
+                offsets.tobytes(),
+                *texts,
+            ]
+        )
+
+    def __len__(self):
+        return len(self.records) // self.FIELDS
+
+    def __iter__(self):
+        # decode all the tokens at once, field by field
+        fields = [
+            self.records[field :: self.FIELDS] for field in range(self.FIELDS)
+        ]
+        (
+            toktypes,
+            strings,
+            start_rows,
+            start_columns,
+            end_rows,
+            end_columns,
+        ) = fields
+        return map(
+            tokenize.TokenInfo._make,
+            zip(
+                toktypes,
+                map(self.strings.__getitem__, strings),
+                zip(start_rows, start_columns),
+                zip(end_rows, end_columns),
+                itertools.repeat(""),
+            ),
+        )
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[item] for item in range(*index.indices(len(self)))]
+        elif index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("token index out of range")
+
+        position = index * self.FIELDS
+        toktype, string, *positions = self.records[
+            position : position + self.FIELDS
+        ]
+        return tokenize.TokenInfo(
+            toktype,
+            self.strings[string],
+            tuple(positions[:2]),
+            tuple(positions[2:]),
+            "",
+        )
+
+
+if shared_memory is not None:
+
+    def _share_tokens(stream_tokens):
+        data = TokenBuffer.encode(stream_tokens)
+        memory = shared_memory.SharedMemory(create=True, size=len(data))
+        memory.buf[: len(data)] = data
+        return memory
+
+    def _read_shared_tokens(name):
+        memory = shared_memory.SharedMemory(name)
+        try:
+            return list(TokenBuffer(memory.buf))
+        finally:
+            memory.close()
+            memory.unlink()
+
+    def _transform_shared_tokens(transformer, name):
+        # Runs in the worker processes: read the tokens from (and write the
+        # result to) shared memory, and return the name of the latter.
+        stream_tokens = _read_shared_tokens(name)
+        with _TOKENIZE_LOCK:
+            transformer._register_tokens()
+        budget = transformer._new_budget()
+        budget.start(stream_tokens)
+        stream_tokens = transformer._transform_tokens(
+            transformer._pattern_search(), stream_tokens, budget
+        )
+        memory = _share_tokens(stream_tokens)
+        memory.close()
+        return memory.name
+
+    def transform_many(transformer, sources, workers=None):
+        # Transform the sources on a process pool. The sources are tokenized
+        # here, and the tokens are exchanged with the workers through shared
+        # memory (see TokenBuffer). The transformer should be picklable.
+        sources = list(sources)
+        with ProcessPoolExecutor(workers) as executor:
+            names = []
+            futures = []
+            try:
+                for source in sources:
+                    memory = _share_tokens(transformer._tokenize(source))
+                    memory.close()
+                    names.append(memory.name)
+                for name in names:
+                    futures.append(
+                        executor.submit(
+                            _transform_shared_tokens, transformer, name
+                        )
+                    )
+
+                while futures:
+                    stream_tokens = _read_shared_tokens(futures[0].result())
+                    names.pop(0)
+                    futures.pop(0)
+                    yield transformer._untokenize(
+                        tokenize.untokenize, stream_tokens
+                    )
+            finally:
+                # release the memory of the remaining sources (or their
+                # results) when stopped early or on an error, including the
+                # ones that were shared but not submitted
+                for index, name in enumerate(names):
+                    if index < len(futures) and not futures[index].cancel():
+                        try:
+                            name = futures[index].result()
+                        except Exception:
+                            continue
+                    memory = shared_memory.SharedMemory(name)
+                    memory.close()
+                    memory.unlink()
+
+
+def _import_numpy():
+    # numpy is optional, and only imported when needed so that it does not
+    # slow down importing brm (e.g. for the codec)
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _find_candidates(patterns, type_lists):
+    # Return the indexes of the type lists that one of the patterns may match
+    # in. The type lists are concatenated into one sequence (separated by -1)
+    # and each pattern that is a plain sequence of token types (see
+    # Pattern.parts) is searched in it at once, the token strings and the
+    # anchors are left to the matcher engine. The other patterns may match
+    # anywhere.
+    sequences = []
+    for pattern, _ in patterns:
+        if not pattern.parts:
+            return set(range(len(type_lists)))
+        sequence = []
+        for name, _ in pattern.parts:
+            toktype = getattr(token, name, None)
+            if token.tok_name.get(toktype) != name:
+                # not a token type, the pattern can not match
+                break
+            sequence.append(toktype)
+        else:
+            sequences.append(sequence)
+
+    offsets = [0]
+    for types in type_lists:
+        offsets.append(offsets[-1] + len(types) + 1)
+    candidates = set()
+    if not sequences:
+        return candidates
+
+    numpy = _import_numpy()
+    if numpy is not None:
+        types = numpy.fromiter(
+            itertools.chain.from_iterable(
+                itertools.chain(types, (-1,)) for types in type_lists
+            ),
+            dtype=numpy.int32,
+            count=offsets[-1],
+        )
+        for sequence in sequences:
+            size = len(types) - len(sequence) + 1
+            if size <= 0:
+                continue
+            # compare the shifted views of the types with each token type
+            mask = types[:size] == sequence[0]
+            for offset, toktype in enumerate(sequence[1:], 1):
+                mask &= types[offset : offset + size] == toktype
+            positions = numpy.flatnonzero(mask)
+            candidates.update(
+                (numpy.searchsorted(offsets, positions, "right") - 1).tolist()
+            )
+        return candidates
+
+    # without numpy, the types are searched as bytes (when they fit)
+    if any(toktype >= 255 for types in type_lists for toktype in types):
+        return set(range(len(type_lists)))
+    data = bytes(
+        itertools.chain.from_iterable(
+            itertools.chain(types, (255,)) for types in type_lists
+        )
+    )
+    for sequence in sequences:
+        needle = bytes(sequence)
+        position = data.find(needle)
+        while position != -1:
+            index = bisect.bisect_right(offsets, position) - 1
+            candidates.add(index)
+            # the rest of this type list is already a candidate
+            position = data.find(needle, offsets[index + 1])
+    return candidates
+
+
+def transform_batch(transformer, sources, strictness=False):
+    # Transform many (small) sources at once. The patterns are applied only
+    # to the sources they may match in (see _find_candidates), which skips
+    # most of the per source matching cost on the corpora where few sources
+    # have any matches.
+    patterns = transformer._pattern_search()
+    visiting = transformer._has_dummy() or any(
+        name.startswith("visit_") for name in dir(transformer)
+    )
+    token_lists = []
+    budgets = []
+    for source in sources:
+        stream_tokens = transformer._tokenize(source)
+        budget = transformer._new_budget()
+        budget.start(stream_tokens)
+        if visiting:
+            stream_tokens = transformer._apply_visitors(stream_tokens)
+            budget.check_time()
+        token_lists.append(stream_tokens)
+        budgets.append(budget)
+
+    candidates = _find_candidates(
+        patterns,
+        [
+            [transformer._get_type(stream_token) for stream_token in tokens]
+            for tokens in token_lists
+        ],
+    )
+    outputs = []
+    for index, (stream_tokens, budget) in enumerate(zip(token_lists, budgets)):
+        if index in candidates:
+            stream_tokens = transformer._apply_patterns(
+                patterns, stream_tokens, budget
+            )
+        outputs.append(
+            transformer._untokenize(
+                tokenize.untokenize, stream_tokens, strictness
+            )
         )
-        return brm_codec
+    return outputs
+
+
+def _hash_file(path):
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def _read_head(path):
+    # The first two lines of the file (where PEP 263 cookies can be),
+    # without reading the rest of it.
+    with open(path, "rb") as stream:
+        try:
+            data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can not be mapped
+            return b""
+        with data:
+            end = data.find(b"\n")
+            if end != -1:
+                end = data.find(b"\n", end + 1)
+            return data[:end] if end != -1 else data[:]
+
+
+def _scan_directory(path):
+    cookies, directories = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            elif entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            elif entry.name.endswith(".py") and entry.is_file():
+                try:
+                    head = _read_head(entry.path)
+                except OSError:
+                    continue
+                if b"brm" not in head:
+                    continue
+                if head.startswith(codecs.BOM_UTF8):
+                    head = head[len(codecs.BOM_UTF8) :]
+                cookie = _find_coding_cookie(head)
+                if cookie is not None:
+                    _, match = cookie
+                    cookies.append((entry.path, match.group(1)))
+    return cookies, directories
+
+
+def find_brm_files(*paths, workers=None):
+    # Yield (path, underlying encoding) for every brm encoded file under
+    # the given directories (skipping the hidden ones), scanning them on
+    # a thread pool.
+    encodings = {}
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(_scan_directory, path) for path in paths}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                cookies, directories = future.result()
+                pending.update(
+                    executor.submit(_scan_directory, directory)
+                    for directory in directories
+                )
+                for path, cookie in cookies:
+                    if cookie not in encodings:
+                        encodings[cookie] = parse_encoding(
+                            cookie.decode("ascii")
+                        )
+                    if encodings[cookie] is not None:
+                        encoding, _ = encodings[cookie]
+                        yield Path(path), encoding
+
+
+class Watcher:
+    def __init__(self, source, output, interval=0.5, debounce=0.2):
+        self.source = Path(source)
+        self.output = Path(output)
+        self.interval = interval
+        self.debounce = debounce
+        self.hashes = {}
+        self.stamps = {}
+        # the sources that have a transformed version in the output
+        self.outputs = set()
+        self.fingerprint = None
+
+    def get_fingerprint(self):
+        return _get_fingerprint(load_manifest())
+
+    def snapshot(self):
+        snapshot = {}
+        for path in (
+            *self.source.glob("**/*.py"),
+            *_get_transformer_paths(),
+        ):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            snapshot[path] = stat.st_mtime_ns, stat.st_size
+        return snapshot
+
+    def build(self):
+        fingerprint = self.get_fingerprint()
+        if fingerprint != self.fingerprint:
+            # a transformer changed, everything needs to be transformed again
+            self.hashes.clear()
+            self.fingerprint = fingerprint
+
+        changed = []
+        seen = set()
+        for source_path in self.source.glob("**/*.py"):
+            path = source_path.relative_to(self.source)
+            seen.add(path)
+            stat = source_path.stat()
+            stamp = stat.st_mtime_ns, stat.st_size
+            if path in self.hashes and self.stamps.get(path) == stamp:
+                continue
+
+            self.stamps[path] = stamp
+            content_hash = _hash_file(source_path)
+            if self.hashes.get(path) == content_hash:
+                continue
+
+            try:
+                data = transform_file(source_path.read_bytes())
+            except Exception as exc:
+                print(f"{path}: {exc}")
+                continue
+
+            destination = self.output / path
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            destination.write_bytes(data)
+            self.hashes[path] = content_hash
+            self.outputs.add(path)
+            changed.append(path)
 
+        for path in self.outputs - seen:
+            try:
+                (self.output / path).unlink()
+            except FileNotFoundError:
+                pass
+            self.outputs.remove(path)
+            self.hashes.pop(path, None)
+            self.stamps.pop(path, None)
+            changed.append(path)
+        return changed
+
+    def watch(self):
+        yield self.build()
+        snapshot = self.snapshot()
+        while True:
+            time.sleep(self.interval)
+            current = self.snapshot()
+            if current == snapshot:
+                continue
 
-def main():
-    print(TRANSFORMER_PATH)
+            # wait until a burst of changes settles
+            while True:
+                time.sleep(self.debounce)
+                latest = self.snapshot()
+                if latest == current:
+                    break
+                current = latest
+
+            snapshot = current
+            yield self.build()
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="brm")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser(
+        "index", help="rebuild the manifest of the installed transformers"
+    )
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="keep the transformers warm behind a unix socket"
+    )
+    serve_parser.add_argument("--socket", type=Path, default=SOCKET_PATH)
+    serve_parser.add_argument("--workers", type=int)
+
+    transform_parser = subparsers.add_parser(
+        "transform", help="transform a file through a running server"
+    )
+    transform_parser.add_argument(
+        "file", type=argparse.FileType(), nargs="?", default="-"
+    )
+    transform_parser.add_argument("--socket", type=Path, default=SOCKET_PATH)
+    transform_parser.add_argument(
+        "--transformers",
+        type=lambda names: names.split(","),
+        help="comma separated transformer names (defaults to all)",
+    )
+
+    compile_parser = subparsers.add_parser(
+        "compile-transformer",
+        help="generate specialized versions of the installed transformers",
+    )
+    compile_parser.add_argument(
+        "transformers",
+        nargs="*",
+        help="module or class names of the transformers (defaults to all)",
+    )
+
+    importtime_parser = subparsers.add_parser(
+        "importtime",
+        help="report the decode costs of the brm encoded modules of an import",
+    )
+    importtime_parser.add_argument("module")
+    importtime_parser.add_argument(
+        "--json", action="store_true", help="print the report as JSON"
+    )
+
+    scan_parser = subparsers.add_parser(
+        "scan", help="list the brm encoded files under the given directories"
+    )
+    scan_parser.add_argument("paths", type=Path, nargs="+")
+    scan_parser.add_argument("--workers", type=int)
+
+    watch_parser = subparsers.add_parser(
+        "watch", help="keep a transformed copy of a source tree up to date"
+    )
+    watch_parser.add_argument("source", type=Path)
+    watch_parser.add_argument("output", type=Path)
+    watch_parser.add_argument("--interval", type=float, default=0.5)
+    watch_parser.add_argument("--debounce", type=float, default=0.2)
+    options = parser.parse_args(argv)
+
+    if options.command == "index":
+        build_manifest()
+        print(MANIFEST_PATH)
+    elif options.command == "serve":
+        with TransformServer(options.socket, options.workers) as server:
+            server.warm_up()
+            print(f"Serving on {options.socket}", flush=True)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    elif options.command == "transform":
+        with options.file:
+            source = options.file.read()
+        print(
+            transform_remote(
+                source, _parse_selection(options.transformers), options.socket
+            ),
+            end="",
+        )
+    elif options.command == "compile-transformer":
+        selection = _parse_selection(options.transformers or None)
+        for path in _get_transformer_paths():
+            module = _import_transformer_module(path)
+            for name, _ in _get_transformer_classes(module):
+                if _is_selected(path, name, selection):
+                    print(compile_transformer(path, name))
+    elif options.command == "importtime":
+        profile = profile_import(options.module)
+        if options.json:
+            print(json.dumps(profile.report(), indent=4))
+        else:
+            print(profile.format())
+    elif options.command == "scan":
+        for path, encoding in find_brm_files(
+            *options.paths, workers=options.workers
+        ):
+            print(path, encoding)
+    elif options.command == "watch":
+        watcher = Watcher(
+            options.source, options.output, options.interval, options.debounce
+        )
+        try:
+            for changed in watcher.watch():
+                for path in changed:
+                    print(f"Transformed {path}", flush=True)
+        except KeyboardInterrupt:
+            pass
+    else:
+        print(TRANSFORMER_PATH)
 
 
 if __name__ == "__main__":
-    main()
+    # under python -m brm this module runs as __main__, while the installed
+    # transformers subclass brm.TokenTransformer (and share the state of the
+    # brm module), so the commands are run from the latter
+    import brm
+
+    brm.main()
@@ -1,12 +1,20 @@
 from __future__ import annotations
 
 import argparse
+import ast
 import difflib
+import hashlib
+import io
+import json
+import re
 import token
+import tokenize
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
+from pathlib import Path
 from typing import Dict, List
 
-from brm import NoLineTransposer, Priority, TokenTransformer, pattern
+from brm import Anchor, NoLineTransposer, Priority, TokenTransformer, pattern
 
 __author__ = "Batuhan Taskaya"
 __copyright__ = f"Copyright 2019, {__author__}"
@@ -32,14 +40,12 @@ class ImportFixer(TokenTransformer):
     # import foo, foo.bar
     # import foo.bar, bar.foo
     @pattern(
-        "name",
+        "name=import",
         f"({dot_name}( comma (nl )?{dot_name})*( nl)?)",
         newline_group,
+        anchor=Anchor.LINE,
     )
     def fix_import_stmt(self, stmt, *tokens, removals=None):
-        if stmt.string != "import":
-            return
-
         module = []
         commas = {}
         modules = {}
@@ -152,17 +158,15 @@ class ImportFixer(TokenTransformer):
     # from foo.bar import bar, bar.baz
 
     @pattern(
-        "name",
+        "name=from",
         dot_name,
-        "name",
+        "name=import",
         f"({dot_name}( comma {dot_name})*)",
         newline_group,
+        anchor=Anchor.LINE,
     )
     @Priority.CANCEL_PENDING
     def fix_from_import_stmt(self, stmt, *tokens):
-        if stmt.string != "from":
-            return
-
         stream_token = iter(tokens)
         module = [next(stream_token)]
         module_parts, current = self.find_module_for_from_import_stmt(
@@ -199,19 +203,17 @@ class ImportFixer(TokenTransformer):
     # )
 
     @pattern(
-        "name",
+        "name=from",
         dot_name,
-        "name",
+        "name=import",
         "lpar",
         f"((nl )?{dot_name}( comma (nl )?{dot_name})*( nl)?)",
         "rpar",
         newline_group,
+        anchor=Anchor.LINE,
     )
     @Priority.CANCEL_PENDING
     def test(self, from_stmt, *tokens):
-        if from_stmt.string != "from":
-            return
-
         stream_token = iter(tokens)
         module = [next(stream_token)]
         module_parts, import_stmt = self.find_module_for_from_import_stmt(
@@ -300,29 +302,292 @@ class ImportFixer(TokenTransformer):
             ]
 
 
+INDEX_VERSION = 2
+SKIPPED_TOKENS = frozenset(
+    (
+        token.NL,
+        token.COMMENT,
+        token.INDENT,
+        token.DEDENT,
+        token.ENDMARKER,
+    )
+)
+
+
+def read_source(data):
+    encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+    return data.decode(encoding), encoding
+
+
+def logical_lines(source):
+    line = []
+    for token_info in tokenize.generate_tokens(io.StringIO(source).readline):
+        if token_info.type in SKIPPED_TOKENS:
+            continue
+        elif token_info.type == token.NEWLINE:
+            yield line
+            line = []
+        else:
+            line.append(token_info)
+    if line:
+        yield line
+
+
+def split_names(tokens):
+    # a, b.c, (d, e) => [["a"], ["b", ".", "c"], ["d"], ["e"]]
+    names = [[]]
+    for token_info in tokens:
+        if token_info.string == ",":
+            names.append([])
+        elif token_info.string not in "()":
+            names[-1].append(token_info.string)
+    return [name for name in names if name]
+
+
+def sole_imports(source):
+    # Yield the imports that are the only statement of a block, removing
+    # them would leave the block empty.
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Module):
+            continue
+        for field in ("body", "orelse", "finalbody"):
+            body = getattr(node, field, None)
+            if (
+                isinstance(body, list)
+                and len(body) == 1
+                and isinstance(body[0], (ast.Import, ast.ImportFrom))
+            ):
+                yield body[0]
+
+
+def scan_source(source):
+    # Index the imports that ImportFixer can rewrite (no aliases, no star
+    # or relative imports) and every name that is referenced elsewhere.
+    imports, from_imports, references = [], [], set()
+    for node in sole_imports(source):
+        # kept as if they were referenced
+        for alias in node.names:
+            references.add(alias.name.split(".")[0])
+            references.add(alias.name)
+    for line in logical_lines(source):
+        strings = [token_info.string for token_info in line]
+        if strings[0] == "import" and "as" not in strings:
+            for name in split_names(line[1:]):
+                imports.append(["".join(name), name[0]])
+        elif (
+            strings[0] == "from"
+            and "import" in strings
+            and line[1].type == token.NAME
+            and not {"as", "*"} & set(strings)
+        ):
+            position = strings.index("import")
+            module = "".join(strings[1:position])
+            if module != "__future__":
+                for name in split_names(line[position + 1 :]):
+                    from_imports.append([module, "".join(name)])
+        elif strings[0] not in {"import", "from"}:
+            for token_info in line:
+                if token_info.type == token.NAME:
+                    references.add(token_info.string)
+                elif token_info.type == token.STRING:
+                    # __all__ entries, string annotations
+                    references.update(re.findall(r"\w+", token_info.string))
+            continue
+
+        # names bound by the imports that are not rewritable
+        if strings[0] == "import" or strings[0] == "from":
+            if "as" in strings or "*" in strings or line[1].type != token.NAME:
+                references.update(
+                    token_info.string
+                    for token_info in line
+                    if token_info.type == token.NAME
+                )
+    return {
+        "imports": imports,
+        "from_imports": from_imports,
+        "references": sorted(references),
+    }
+
+
+def get_removals(index):
+    references = set(index["references"])
+    from_modules = {module for module, _ in index["from_imports"]}
+    bound_names = {bound for _, bound in index["imports"]}
+    modules = sorted(
+        {
+            module
+            for module, bound in index["imports"]
+            if bound not in references and module not in from_modules
+        }
+    )
+    names = sorted(
+        {
+            name
+            for _, name in index["from_imports"]
+            if name not in references and name not in bound_names
+        }
+    )
+    return modules, names
+
+
+def scan_file(path):
+    data = path.read_bytes()
+    index = {"hash": hashlib.sha256(data).hexdigest()}
+    try:
+        source, _ = read_source(data)
+        index.update(scan_source(source))
+    except (SyntaxError, UnicodeDecodeError, tokenize.TokenError) as exc:
+        index["error"] = str(exc)
+    return index
+
+
+def fix_file(path, modules, names, max_passes=8):
+    source, encoding = read_source(path.read_bytes())
+    fixer = ImportFixer(modules, names)
+    result = source
+    for _ in range(max_passes):
+        # a rewritten from import cancels the rest of the patterns (see
+        # Priority.CANCEL_PENDING), so repeat until nothing changes
+        new_result = fixer.transform(result)
+        if new_result == result:
+            break
+        result = new_result
+    return source, result, encoding
+
+
+def scan_project(root, cache_path, jobs=None):
+    try:
+        with open(cache_path) as stream:
+            cache = json.load(stream)
+    except (OSError, ValueError):
+        cache = {}
+    if cache.get("version") != INDEX_VERSION:
+        cache = {"version": INDEX_VERSION, "files": {}}
+
+    indexes, changed = {}, []
+    for path in sorted(root.glob("**/*.py")):
+        if path.name == "__init__.py":
+            # imports in packages are usually re-exports
+            continue
+        key = str(path.relative_to(root))
+        index = cache["files"].get(key)
+        content_hash = hashlib.sha256(path.read_bytes()).hexdigest()
+        if index is not None and index["hash"] == content_hash:
+            indexes[key] = index
+        else:
+            changed.append(key)
+
+    with ProcessPoolExecutor(jobs) as executor:
+        for key, index in zip(
+            changed,
+            executor.map(scan_file, [root / key for key in changed]),
+        ):
+            indexes[key] = index
+
+    cache["files"] = indexes
+    with open(cache_path, "w") as stream:
+        json.dump(cache, stream)
+    return indexes, len(changed)
+
+
+def fix_project(root, cache_path, jobs=None):
+    # Yield (path, source, fixed source, encoding) for each file that has
+    # unused imports.
+    indexes, _ = scan_project(root, cache_path, jobs)
+    removals = {
+        key: get_removals(index)
+        for key, index in indexes.items()
+        if "error" not in index
+    }
+    removals = {
+        key: (modules, names)
+        for key, (modules, names) in removals.items()
+        if modules or names
+    }
+
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = {
+            key: executor.submit(fix_file, root / key, modules, names)
+            for key, (modules, names) in removals.items()
+        }
+        for key, future in futures.items():
+            try:
+                source, result, encoding = future.result()
+            except Exception as exc:
+                print(f"{key}: {exc}")
+                continue
+            if source == result:
+                continue
+            try:
+                compile(result, str(root / key), "exec")
+            except SyntaxError as exc:
+                print(f"{key}: skipped, the fixed source does not compile")
+                print(f"    {type(exc).__name__}: {exc}")
+                continue
+            yield root / key, source, result, encoding
+
+
+def print_diff(content, result, namespace, path="-"):
+    union_skipper = 0
+    for line in difflib.unified_diff(
+        content.splitlines(),
+        result.splitlines(),
+        fromfile=str(path),
+        tofile=str(path),
+        n=namespace.n,
+        lineterm="",
+    ):
+        if namespace.skip_boil and union_skipper < 3:
+            union_skipper += 1
+            continue
+        print(line)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--skip-boil", action="store_true")
     parser.add_argument("--remove-modules", nargs="*")
     parser.add_argument("--remove-names", nargs="*")
     parser.add_argument("-n", type=int, default=2)
+    parser.add_argument(
+        "--project",
+        action="store_true",
+        help="remove the unused imports of every file under the path",
+    )
+    parser.add_argument("--jobs", type=int)
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        help="where to keep the per-file indexes (project mode)",
+    )
+    parser.add_argument(
+        "--write",
+        action="store_true",
+        help="rewrite the files instead of printing a diff (project mode)",
+    )
     parser.add_argument("path")
     namespace = parser.parse_args()
+
+    if namespace.project:
+        root = Path(namespace.path)
+        cache_path = namespace.cache or root / ".remove_imports_cache.json"
+        for path, source, result, encoding in fix_project(
+            root, cache_path, namespace.jobs
+        ):
+            if namespace.write:
+                path.write_bytes(result.encode(encoding))
+                print(f"Fixed {path}")
+            else:
+                print_diff(source, result, namespace, path)
+        return
+
     fixer = ImportFixer(
         namespace.remove_modules or [], namespace.remove_names or []
     )
     with open(namespace.path) as f:
         content = f.read()
         result = fixer.transform(content)
-
-    union_skipper = 0
-    for line in difflib.unified_diff(
-        content.splitlines(), result.splitlines(), n=namespace.n
-    ):
-        if namespace.skip_boil and union_skipper < 3:
-            union_skipper += 1
-            continue
-        print(line)
+    print_diff(content, result, namespace, namespace.path)
 
 
 if __name__ == "__main__":
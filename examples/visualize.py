@@ -1,53 +1,50 @@
 # requirements: svgwrite
-import token
+import json
 import webbrowser
 from argparse import ArgumentParser, FileType
 from contextlib import contextmanager
 from string import Template
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryFile
 
 import svgwrite
 
 from brm import TokenTransformer, pattern
 
 
-def create_board(transformer, stream_tokens, highlight, pattern=None):
-    drawing = svgwrite.Drawing()
+def create_board(stream_tokens, pattern=None):
+    # The board is rendered only once, each frame just highlights
+    # some of the tokens on it (by their index).
+    height = 100 + max((end[0] for *_, end in stream_tokens), default=0) * 25
+    width = 100 + max((end[1] for *_, end in stream_tokens), default=0) * 7
+    drawing = svgwrite.Drawing(size=(f"{width}px", f"{height}px"))
     drawing.add(
         drawing.rect(
             insert=(0, 0),
-            size=("600px", "600px"),
+            size=(f"{width}px", f"{height}px"),
             stroke_width="5",
             stroke="black",
             fill="white",
         )
     )
     text = drawing.text("BRM", font_family="monospace")
-    for stream_token in stream_tokens:
-        x_pos = 50 + stream_token.start[1] * 7
-        y_pos = 25 + stream_token.start[0] * 25
-        source = stream_token.string
-
-        if stream_token in highlight:
-            if stream_token.type == token.NEWLINE:
-                source = "|"
-                x_pos += 7
-            elif stream_token.type == token.INDENT:
-                source = "*" * len(stream_token.string)
+    for index, (name, source, start, end) in enumerate(stream_tokens):
+        x_pos = 50 + start[1] * 7
+        y_pos = 25 + start[0] * 25
+        if name in {"NEWLINE", "NL"}:
+            source = "|"
+        elif name == "INDENT":
+            source = "*" * len(source)
 
         for extra, line in enumerate(source.splitlines()):
             span = drawing.tspan(line, insert=(x_pos, y_pos + 25 * extra))
-            if stream_token in highlight:
-                span.stroke(color="red")
+            span["class"] = f"token-{index}"
             text.add(span)
 
     if pattern is not None:
-        cursor = drawing.tspan(f"Pattern: {pattern}", (100, y_pos + 50))
+        cursor = drawing.tspan(f"Pattern: {pattern}", (100, height - 25))
     else:
-        cursor = drawing.tspan(
-            f"Current token: {transformer._get_name(*highlight)}",
-            (100, y_pos + 50),
-        )
+        cursor = drawing.tspan("Current token: ", (100, height - 25))
+        cursor.add(drawing.tspan("", id="current"))
 
     cursor.stroke(color="black")
     text.add(cursor)
@@ -55,9 +52,27 @@ def create_board(transformer, stream_tokens, highlight, pattern=None):
     return drawing.tostring()
 
 
+def read_frames(trace, use_matches):
+    # Stream the highlighted token indexes (and their names) of each frame
+    # from the recorded trace of a transform.
+    stream_tokens = None
+    for line in trace:
+        event, *arguments = json.loads(line)
+        if event == "tokens" and stream_tokens is None:
+            stream_tokens = arguments[0]
+            yield stream_tokens
+        elif event == "match" and use_matches:
+            _, start, stop = arguments
+            yield list(range(start, stop)), ""
+        elif event == "visit" and not use_matches:
+            index, name = arguments
+            yield [index], name
+
+
 @contextmanager
-def document(page, transformer, tokens):
-    page.write("<html><head><title>BRM Visualizer</title></head><body>")
+def document(page):
+    page.write("<html><head><title>BRM Visualizer</title>")
+    page.write("<style>.highlight { stroke: red; }</style></head><body>")
     yield page
     page.write("</body></html>")
 
@@ -77,43 +92,50 @@ def main():
         default=None,
         help="pattern to visualize on board",
     )
+    parser.add_argument(
+        "--trace",
+        type=FileType(),
+        help=(
+            "visualize a recorded trace"
+            " (TokenTransformer.transform(trace=...))"
+        ),
+    )
     args = parser.parse_args()
 
-    transformer = TokenTransformer()
-    source = args.file.read()
-    tokens = transformer.quick_tokenize(source)
-    args.file.close()
-    print("Processing input...")
-
-    if tokens[-1].end[0] > 18:
-        raise ValueError("input file should contain less then 15 lines")
-
-    if args.pattern:
-        matches = []
-
-        @pattern(args.pattern)
-        def set_args(*tokens):
-            matches.append(tokens)
-
-        transformer._internal = set_args
-        transformer.transform(source)
-
-    page = NamedTemporaryFile("w", delete=False, buffering=1)
-    with document(page, transformer, tokens) as doc:
-        for frame, token in enumerate(tokens):
-            idx = f"frame_{frame}"
-            highlight = matches[frame] if args.pattern else {token}
-            doc.write(
-                f'<div id="frame_{frame}" style="display:'
-                f' none">{create_board(transformer, tokens, highlight, args.pattern)}</div>'
-            )
-            if args.pattern and frame + 1 == len(matches):
-                break
-
-        page.write(STATIC_HTML.substitute({"total_frames": frame + 1}))
-
-    webbrowser.open(page.name)
+    if args.trace is not None:
+        trace = args.trace
+    else:
+        transformer = TokenTransformer()
+        if args.pattern:
+
+            @pattern(args.pattern)
+            def set_args(*tokens):
+                return None
+
+            transformer._internal = set_args
+
+        source = args.file.read()
+        args.file.close()
+        print("Processing input...")
+        trace = TemporaryFile("w+")
+        transformer.transform(source, trace=trace)
+        trace.seek(0)
+
+    frames = read_frames(trace, use_matches=bool(args.pattern))
+    stream_tokens = next(frames)
+
+    page = NamedTemporaryFile("w", suffix=".html", delete=False)
+    with document(page) as doc:
+        doc.write(create_board(stream_tokens, args.pattern))
+        doc.write("<script>var frames = [")
+        for highlight, name in frames:
+            doc.write(json.dumps([highlight, name]) + ",")
+        doc.write("];</script>")
+        doc.write(STATIC_HTML.substitute())
+
+    trace.close()
     page.close()
+    webbrowser.open(page.name)
 
 
 # I SUCK AT SVGS
@@ -127,14 +149,25 @@ def main():
 STATIC_HTML = Template(
     """
 <script>
-var i = 0, last;
+var i = 0, last = [];
+var current = document.getElementById("current");
 var interval_id = setInterval(function () {
-        var div = document.getElementById("frame_" + i);
-        div.style.display = "block";
-        last && (last.style.display = "none");
-        last = div;
-        i = (i+1)%${total_frames};
-        console.log("showing" + i);
+        if (frames.length == 0) {
+            return;
+        }
+        last.forEach(function (span) {
+            span.classList.remove("highlight");
+        });
+        last = [];
+        frames[i][0].forEach(function (index) {
+            var spans = document.getElementsByClassName("token-" + index);
+            for (var span of spans) {
+                span.classList.add("highlight");
+                last.push(span);
+            }
+        });
+        current && (current.textContent = frames[i][1]);
+        i = (i+1)%frames.length;
     },
 550);
 </script>
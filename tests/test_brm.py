@@ -1,8 +1,23 @@
+import io
+import json
+import os
+import sys
+import threading
 import tokenize
+import warnings
 
 import pytest
 
-from brm import TokenTransformer, pattern
+import brm
+from brm import (
+    Anchor,
+    BudgetExceeded,
+    BudgetWarning,
+    PatternError,
+    Priority,
+    TokenTransformer,
+    pattern,
+)
 
 REAL_CODE = """
 class X:
@@ -86,3 +101,1139 @@ def test_token_transformer_directional_length(transformer):
     from_import_stmt = transformer.quick_tokenize("from foo import bar, baz")
     assert transformer.directional_length(import_stmt) == 10
     assert transformer.directional_length(from_import_stmt[3:]) == 8
+
+
+def test_token_transformer_overlapping_matches():
+    class Foo(TokenTransformer):
+        @pattern("number", "plus", "number")
+        def add(self, left, plus, right):
+            (result,) = self.quick_tokenize(
+                str(int(left.string) + int(right.string))
+            )
+            return [result]
+
+    foo = Foo()
+    # (1 + 2) conflicts with (2 + 3), only the leftmost one is applied
+    assert foo.transform("1 + 2 + 3") == "3 + 3"
+
+
+def test_token_transformer_conflict_policies():
+    class Foo(TokenTransformer):
+        @pattern("name", "name")
+        def short(self, first, second):
+            return [first._replace(string="short"), second]
+
+        @pattern("name", "name", "name")
+        @Priority.FIRST
+        def long(self, first, *rest):
+            return [first._replace(string="long"), *rest]
+
+        @pattern("name", "name")
+        @Priority.LAST
+        def tail(self, first, second):
+            return [first, second._replace(string="tail")]
+
+    assert Foo().transform("a b c") == "long b c"
+
+    Foo.CONFLICT_POLICY = "priority"
+    assert Foo().transform("a b c") == "long b c"
+
+    Foo.CONFLICT_POLICY = lambda match: -match.start
+    assert Foo().transform("a b c") == "a short c"
+
+
+def test_token_transformer_cancel_pending():
+    class Foo(TokenTransformer):
+        @pattern("name", "equal", "number")
+        @Priority.CANCEL_PENDING
+        def cancel(self, name, equal, number):
+            if name.string == "cancel":
+                return [name, equal, number._replace(string="0")]
+
+        @pattern("number")
+        def replace_numbers(self, number):
+            return [number._replace(string="1")]
+
+    foo = Foo()
+    assert foo.transform("x = 5\ny = 6") == "x = 1\ny = 1"
+    assert foo.transform("cancel = 5\ny = 6") == "cancel = 0\ny = 6"
+
+
+def test_token_transformer_fixed_point():
+    class Foo(TokenTransformer):
+        @pattern("lpar", "number", "rpar")
+        def unwrap(self, lpar, number, rpar):
+            return [number]
+
+    assert Foo().transform("x = (((1)))") == "x = ((1))"
+
+    Foo.FIXED_POINT = True
+    assert Foo().transform("x = (((1))) + ((2))") == "x = 1 + 2"
+
+    Foo.MAX_ITERATIONS = 2
+    assert Foo().transform("x = (((1)))") == "x = (1)"
+
+
+def test_token_transformer_budgets():
+    class Foo(TokenTransformer):
+        @pattern("number")
+        def explode(self, number):
+            return self.quick_tokenize(" + ".join([number.string] * 10))
+
+    foo = Foo()
+    assert foo.transform("1") == "1 + 1 + 1 + 1 + 1 + 1 + 1 + 1 + 1 + 1"
+
+    Foo.MAX_ATTEMPTS = 2
+    with pytest.raises(BudgetExceeded) as exc_info:
+        foo.transform("a = 1")
+    assert exc_info.value.budget == "attempts"
+
+    Foo.MAX_ATTEMPTS = None
+    Foo.MAX_GROWTH = 2
+    with pytest.raises(BudgetExceeded) as exc_info:
+        foo.transform("a = 1")
+    assert exc_info.value.budget == "growth"
+
+
+def test_decode_skips_transformers_over_budget(monkeypatch):
+    class Slow(TokenTransformer):
+        MAX_TIME = 0
+
+        def visit_name(self, token):
+            return token._replace(string="slow")
+
+    class Fast(TokenTransformer):
+        def visit_number(self, token):
+            return token._replace(string="2")
+
+    monkeypatch.setattr(
+        brm, "get_transformers", lambda *args: iter([Slow(), Fast()])
+    )
+    with pytest.warns(BudgetWarning) as warning_info:
+        source, _ = brm.decode("a = 1\n")
+
+    assert source == "a = 2\n"
+    (warning,) = warning_info
+    assert warning.message.transformer == "Slow"
+    assert warning.message.budget == "time"
+
+
+def test_token_transformer_anchored_patterns():
+    class Foo(TokenTransformer):
+        @pattern("name", "name", anchor=Anchor.LINE)
+        def line(self, first, second):
+            return [first._replace(string="x"), second]
+
+    source = "a b\nif c:\n    d e\nf(g h,\n  i j)\n"
+    assert Foo().transform(source) == "x b\nx c:\n    x e\nf(g h,\n  i j)\n"
+
+    class Foo(TokenTransformer):
+        @pattern("name", "name", anchor=Anchor.BLOCK)
+        def block(self, first, second):
+            return [first._replace(string="x"), second]
+
+    assert Foo().transform(source) == "a b\nif c:\n    x e\nf(g h,\n  i j)\n"
+
+
+DOLLAR_TRANSFORMER = """
+import tokenize
+from brm import TokenTransformer
+
+LOADED.append("dollar")
+
+class Dollar(TokenTransformer):
+    def register_dollar(self):
+        return "$"
+
+    def visit_dollar(self, token):
+        return token._replace(string="==", type=tokenize.OP)
+"""
+
+LSQB_TRANSFORMER = """
+from brm import TokenTransformer, pattern
+
+LOADED.append("lsqb")
+
+class Index(TokenTransformer):
+    @pattern("lsqb", "number", "rsqb")
+    def zero(self, lsqb, number, rsqb):
+        return [lsqb, number._replace(string="0"), rsqb]
+"""
+
+
+@pytest.fixture
+def transformer_path(tmp_path, monkeypatch):
+    import builtins
+
+    monkeypatch.setattr(brm, "TRANSFORMER_PATH", tmp_path)
+    monkeypatch.setattr(brm, "MANIFEST_PATH", tmp_path / "manifest.json")
+    monkeypatch.setattr(brm, "COMPILED_PATH", tmp_path / ".compiled")
+    monkeypatch.setattr(builtins, "LOADED", [], raising=False)
+    return tmp_path
+
+
+def test_transformer_manifest(transformer_path, monkeypatch):
+    import builtins
+
+    (transformer_path / "dollar.py").write_text(DOLLAR_TRANSFORMER)
+    (transformer_path / "lsqb.py").write_text(LSQB_TRANSFORMER)
+
+    manifest = brm.build_manifest()
+    dollar, lsqb = manifest["modules"]
+    (transformer,) = dollar["transformers"]
+    assert transformer["name"] == "Dollar"
+    assert transformer["triggers"] == ["$"]
+    assert transformer["requirements"] == [["DOLLAR"]]
+    (transformer,) = lsqb["transformers"]
+    assert transformer["requirements"] == [["LSQB", "NUMBER", "RSQB"]]
+
+    builtins.LOADED.clear()
+    assert brm.decode("a = 1\n") == ("a = 1\n", 6)
+    assert builtins.LOADED == []
+
+    assert brm.decode("a[1] $ 2\n") == ("a[0] == 2\n", 10)
+    assert sorted(builtins.LOADED) == ["dollar", "lsqb"]
+
+    # the manifest is not parsed again while nothing changes
+    load = json.load
+    loads = []
+
+    def counted_load(stream):
+        loads.append(stream)
+        return load(stream)
+
+    monkeypatch.setattr(json, "load", counted_load)
+    assert brm.decode("a[1] $ 2\n") == ("a[0] == 2\n", 10)
+    assert brm.decode("a[2] $ 3\n") == ("a[0] == 3\n", 10)
+    assert loads == []
+    monkeypatch.setattr(json, "load", load)
+
+    # the manifest is refreshed when a transformer changes
+    (transformer_path / "dollar.py").write_text(
+        DOLLAR_TRANSFORMER.replace('"$"', '"@@"')
+    )
+    os.utime(transformer_path / "dollar.py", ns=(0, 0))
+    assert brm.decode("a $ 2\n") == ("a $ 2\n", 6)
+    assert brm.load_manifest()["modules"][0]["transformers"][0][
+        "triggers"
+    ] == ["@@"]
+
+
+def test_transformer_manifest_concurrent_rebuild(
+    transformer_path, monkeypatch
+):
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    (transformer_path / "dollar.py").write_text(DOLLAR_TRANSFORMER)
+    brm.build_manifest()
+    barrier = threading.Barrier(8)
+    dump = json.dump
+
+    def slow_dump(*args, **kwargs):
+        # widen the window between writing and replacing the manifest
+        dump(*args, **kwargs)
+        time.sleep(0.01)
+
+    monkeypatch.setattr(json, "dump", slow_dump)
+
+    def decode(index):
+        barrier.wait()
+        return brm.decode(f"a $ {index}\n")[0]
+
+    # every thread finds the manifest missing at once
+    for _ in range(5):
+        (transformer_path / "manifest.json").unlink()
+        with ThreadPoolExecutor(8) as executor:
+            outputs = list(executor.map(decode, range(8)))
+        assert outputs == [f"a == {index}\n" for index in range(8)]
+    # no temporary manifests are left behind
+    assert sorted(path.name for path in transformer_path.iterdir()) == [
+        "dollar.py",
+        "manifest.json",
+    ]
+
+
+def test_transformer_manifest_keeps_later_transformers(transformer_path):
+    (transformer_path / "a_foo.py").write_text(FOO_TRANSFORMER)
+    (transformer_path / "b_bar.py").write_text(
+        FOO_TRANSFORMER.replace("foo", "bar").replace('"bar"', '"baz"')
+    )
+    (transformer_path / "c_lsqb.py").write_text(LSQB_TRANSFORMER)
+
+    # b_bar only becomes relevant after a_foo's rewrite
+    assert brm.decode("foo\n") == ("baz\n", 4)
+    assert brm.decode("x[1]\n") == ("x[0]\n", 5)
+
+
+@pytest.fixture
+def run_brm(tmp_path):
+    # Run python -m brm in a subprocess, with ~/.brm under tmp_path
+    import subprocess
+
+    home = tmp_path / "home"
+    (home / ".brm").mkdir(parents=True)
+    (home / ".brm" / "dollar.py").write_text(
+        "LOADED = []\n" + DOLLAR_TRANSFORMER
+    )
+    env = dict(
+        os.environ,
+        HOME=str(home),
+        PYTHONPATH=os.path.dirname(os.path.abspath(brm.__file__)),
+    )
+
+    def run_brm(*args, **kwargs):
+        kwargs.setdefault("stdout", subprocess.PIPE)
+        return subprocess.Popen(
+            [sys.executable, "-m", "brm", *args],
+            env=env,
+            universal_newlines=True,
+            **kwargs,
+        )
+
+    run_brm.home = home
+    return run_brm
+
+
+def test_cli_index(run_brm):
+    process = run_brm("index")
+    assert process.wait() == 0
+    manifest = json.loads(
+        (run_brm.home / ".brm" / "manifest.json").read_text()
+    )
+    (module,) = manifest["modules"]
+    assert [transformer["name"] for transformer in module["transformers"]] == [
+        "Dollar"
+    ]
+
+
+@pytest.mark.skipif(
+    not hasattr(brm, "TransformServer"), reason="requires unix sockets"
+)
+def test_cli_serve(run_brm):
+    import subprocess
+
+    socket_path = str(run_brm.home / "brm.sock")
+    server = run_brm("serve", "--socket", socket_path)
+    try:
+        assert server.stdout.readline().startswith("Serving on")
+        client = run_brm(
+            "transform", "--socket", socket_path, stdin=subprocess.PIPE
+        )
+        output, _ = client.communicate("a $ 2\n")
+        assert client.returncode == 0
+        assert output == "a == 2\n"
+    finally:
+        server.terminate()
+        server.wait()
+        server.stdout.close()
+
+
+def test_cli_watch(run_brm, tmp_path):
+    source, output = tmp_path / "source", tmp_path / "output"
+    source.mkdir()
+    (source / "module.py").write_text("# coding: brm\na $ 2\n")
+    watcher = run_brm("watch", str(source), str(output), "--interval", "0.05")
+    try:
+        assert watcher.stdout.readline() == "Transformed module.py\n"
+        assert (output / "module.py").read_text() == "# coding: utf8\na == 2\n"
+    finally:
+        watcher.terminate()
+        watcher.wait()
+        watcher.stdout.close()
+
+
+def test_cli_importtime(run_brm, tmp_path):
+    (tmp_path / "brm_cli_module.py").write_text("# coding: brm\na = 1 $ 1\n")
+    process = run_brm(
+        "importtime", "brm_cli_module", "--json", cwd=str(tmp_path)
+    )
+    output, _ = process.communicate()
+    assert process.returncode == 0
+    [entry] = json.loads(output)["modules"]
+    assert entry["module"] == "brm_cli_module"
+    assert list(entry["transformers"]) == ["Dollar"]
+
+
+def test_token_transformer_string_constraints():
+    calls = []
+
+    class Foo(TokenTransformer):
+        @pattern("name=from|import", "name", "newline")
+        def mark(self, keyword, name, newline):
+            calls.append(keyword.string)
+            return [keyword, name._replace(string="x"), newline]
+
+        @pattern("name", "equal", "number=1")
+        def one(self, name, equal, number):
+            calls.append(number.string)
+            return [name, equal, number._replace(string="2")]
+
+    source = "import a\nfoo b\nfrom c\nd = 1\ne = 3\n"
+    assert Foo().transform(source) == "import x\nfoo b\nfrom x\nd = 2\ne = 3\n"
+    assert sorted(calls) == ["1", "from", "import"]
+
+    with pytest.raises(PatternError):
+        pattern("*name=foo")(lambda *tokens: None)
+
+
+def test_parse_encoding(transformer_path):
+    (transformer_path / "dollar_eq.py").write_text(DOLLAR_TRANSFORMER)
+    (transformer_path / "lsqb.py").write_text(LSQB_TRANSFORMER)
+
+    assert brm.parse_encoding("utf8") is None
+    assert brm.parse_encoding("brm") == ("utf8", None)
+    assert brm.parse_encoding("brm-latin-1") == ("latin-1", None)
+    assert brm.parse_encoding("brm.dollar_eq.lsqb-latin1") == (
+        "latin1",
+        {"dollar_eq", "lsqb"},
+    )
+    # normalized by codecs.lookup() on 3.9+
+    assert brm.parse_encoding("brm.lsqb.dollar_eq_utf_8") == (
+        "utf_8",
+        {"dollar_eq", "lsqb"},
+    )
+    assert brm.parse_encoding("brm.index") == ("utf8", {"index"})
+
+
+def test_codec_transformer_selection(transformer_path):
+    (transformer_path / "dollar_eq.py").write_text(DOLLAR_TRANSFORMER)
+    (transformer_path / "lsqb.py").write_text(LSQB_TRANSFORMER)
+
+    source = b"a[1] $ 2\n"
+    assert brm.search("brm-utf8").decode(source)[0] == "a[0] == 2\n"
+    assert brm.search("brm.lsqb-utf8").decode(source)[0] == "a[0] $ 2\n"
+    assert brm.search("brm.dollar_eq_utf8").decode(source)[0] == "a[1] == 2\n"
+    assert brm.search("brm.dollar_eq_utf8") is brm.search("brm.dollar_eq_utf8")
+    with pytest.raises(LookupError, match="other"):
+        brm.search("brm.lsqb.other-utf8")
+
+
+def test_codecs_are_cached_per_encoding(transformer_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    latin1 = brm.search("brm-latin1")
+    utf8 = brm.search("brm-utf8")
+    assert brm.search("brm_latin_1") is latin1
+    assert brm.search("brm-utf-8") is utf8
+    assert latin1.incrementaldecoder is not utf8.incrementaldecoder
+
+    source = "a = 'ü'\n"
+
+    def read(codec_and_encoding):
+        codec, encoding = codec_and_encoding
+        decoder = codec.incrementaldecoder()
+        return decoder.decode(source.encode(encoding), final=True)
+
+    with ThreadPoolExecutor(4) as executor:
+        results = executor.map(read, [(latin1, "latin1"), (utf8, "utf8")] * 16)
+    assert set(results) == {source}
+
+
+@pytest.mark.skipif(
+    not hasattr(brm, "TransformServer"), reason="requires unix sockets"
+)
+def test_transform_server(transformer_path):
+    (transformer_path / "dollar_eq.py").write_text(DOLLAR_TRANSFORMER)
+    (transformer_path / "lsqb.py").write_text(LSQB_TRANSFORMER)
+
+    socket_path = transformer_path / "brm.sock"
+    with brm.TransformServer(socket_path, workers=2) as server:
+        server.warm_up()
+        thread = threading.Thread(
+            target=server.serve_forever, args=(0.01,), daemon=True
+        )
+        thread.start()
+        try:
+            assert (
+                brm.transform_remote("a[1] $ 2\n", path=socket_path)
+                == "a[0] == 2\n"
+            )
+            assert (
+                brm.transform_remote(
+                    "a[1] $ 2\n", selection={"lsqb"}, path=socket_path
+                )
+                == "a[0] $ 2\n"
+            )
+            with pytest.raises(brm.RemoteError, match="unknown brm"):
+                brm.transform_remote(
+                    "a[1] $ 2\n", selection={"lsbq"}, path=socket_path
+                )
+        finally:
+            server.shutdown()
+    assert not socket_path.exists()
+
+
+def test_watcher_rebuilds_incrementally(transformer_path, tmp_path_factory):
+    source = tmp_path_factory.mktemp("source")
+    output = tmp_path_factory.mktemp("output")
+    (transformer_path / "lsqb.py").write_text(LSQB_TRANSFORMER)
+    (source / "pkg").mkdir()
+    (source / "pkg" / "a.py").write_text("# coding: brm\na = b[1]\n")
+    (source / "b.py").write_text("b = [1]\n")
+
+    watcher = brm.Watcher(source, output)
+    assert sorted(map(str, watcher.build())) == ["b.py", "pkg/a.py"]
+    assert (
+        output / "pkg" / "a.py"
+    ).read_text() == "# coding: utf8\na = b[0]\n"
+    assert (output / "b.py").read_text() == "b = [1]\n"
+    assert watcher.build() == []
+
+    (source / "b.py").write_text("b = [2]\n")
+    assert list(map(str, watcher.build())) == ["b.py"]
+
+    (transformer_path / "lsqb.py").write_text(
+        LSQB_TRANSFORMER.replace('"0"', '"2"')
+    )
+    os.utime(transformer_path / "lsqb.py", ns=(0, 0))
+    assert sorted(map(str, watcher.build())) == ["b.py", "pkg/a.py"]
+    assert (
+        output / "pkg" / "a.py"
+    ).read_text() == "# coding: utf8\na = b[2]\n"
+
+    (source / "b.py").unlink()
+    assert list(map(str, watcher.build())) == ["b.py"]
+    assert not (output / "b.py").exists()
+
+    # a source that is removed along with a transformer change
+    (source / "c.py").write_text("c = [3]\n")
+    assert list(map(str, watcher.build())) == ["c.py"]
+    (source / "c.py").unlink()
+    (transformer_path / "lsqb.py").write_text(LSQB_TRANSFORMER)
+    os.utime(transformer_path / "lsqb.py", ns=(1, 1))
+    assert sorted(map(str, watcher.build())) == ["c.py", "pkg/a.py"]
+    assert not (output / "c.py").exists()
+
+
+def test_token_transformer_trace():
+    import json
+
+    class Foo(TokenTransformer):
+        @pattern("lsqb", "number", "rsqb")
+        def zero(self, lsqb, number, rsqb):
+            return [lsqb, number._replace(string="0"), rsqb]
+
+    trace = io.StringIO()
+    assert Foo().transform("a[1]", trace=trace) == "a[0]"
+
+    events = [json.loads(line) for line in trace.getvalue().splitlines()]
+    tokens, *visits = [
+        event for event in events if event[0] in {"tokens", "visit"}
+    ][:7]
+    assert [name for name, *_ in tokens[1]] == [
+        "NAME",
+        "LSQB",
+        "NUMBER",
+        "RSQB",
+        "NEWLINE",
+        "ENDMARKER",
+    ]
+    assert visits == [
+        ["visit", index, name] for index, (name, *_) in enumerate(tokens[1])
+    ]
+    assert ["match", 0, 1, 4] in events
+    assert [
+        "replace",
+        1,
+        4,
+        [
+            ["LSQB", "[", [1, 1], [1, 2]],
+            ["NUMBER", "0", [1, 2], [1, 3]],
+            ["RSQB", "]", [1, 3], [1, 4]],
+        ],
+    ] in events
+    assert sum(event[0] == "attempt" for event in events) == 6
+    # the tokens are not dumped again, as no visitor changed them
+    assert sum(event[0] == "tokens" for event in events) == 1
+
+
+def test_token_transformer_templates():
+    class Foo(TokenTransformer):
+        @pattern("name=wait", "name")
+        def wait(self, keyword, expr):
+            return self.template("await {expr}").substitute(
+                keyword.start, expr=expr
+            )
+
+        @pattern("name=swap", "lpar", "name", "comma", "*any", "rpar")
+        def swap(self, keyword, lpar, first, comma, *rest):
+            *second, rpar = rest
+            return self.template("({second}, {first})").substitute(
+                keyword.start, first=first, second=second
+            )
+
+    foo = Foo()
+    assert foo.transform("x = wait foo\n") == "x = await foo\n"
+    assert foo.transform("x = wait barbaz\n") == "x = await barbaz\n"
+    assert (
+        foo.transform("x = swap(a, b.c(d)) + 1\n") == "x = (b.c(d), a) + 1\n"
+    )
+    assert set(Foo._templates) == {"await {expr}", "({second}, {first})"}
+
+    template = foo.template("[\n    {items}\n]")
+    items = foo.quick_tokenize("1,\n2")
+    assert (
+        tokenize.untokenize(template.substitute((1, 4), items=items))
+        == "    [\n    1,\n2\n]"
+    )
+
+
+def test_token_transformer_matches(tmp_path):
+    class Foo(TokenTransformer):
+        @pattern("name=print", "string")
+        def print_statement(self, keyword, value):
+            if value.string != "'skip'":
+                return self.template("print({value})").substitute(
+                    keyword.start, value=value
+                )
+
+    foo = Foo()
+    assert not foo.matches("print('skip')\nprint 'skip'\n")
+    match = foo.first_match("print 'skip'\nx = 1\nprint 'foo'\n")
+    assert (match.start, match.stop) == (7, 9)
+    assert match.visitor == foo.print_statement
+
+    class Bar(TokenTransformer):
+        def visit_number(self, token):
+            if token.string == "1":
+                return token._replace(string="2")
+
+    assert Bar().matches("x = 1\n")
+    assert not Bar().matches("x = 3\n")
+
+    sources = {
+        "a.py": "print 'a'\n",
+        "b.py": "# coding: brm\nprint('b')\n",
+        "c.py": "# coding: brm-latin-1\nprint 'c'\n",
+    }
+    for name, source in sources.items():
+        (tmp_path / name).write_text(source)
+    paths = sorted(tmp_path.iterdir())
+    for workers in (None, 2):
+        assert [
+            path.name for path, _ in brm.find_matches(foo, paths, workers)
+        ] == ["a.py", "c.py"]
+
+
+def test_token_transformer_batched_visitors():
+    class Foo(TokenTransformer):
+        RENAMES = {"foo": "bar", "baz": "qux"}
+
+        def visit_all_name(self, tokens, indexes):
+            return [
+                token._replace(string=self.RENAMES[token.string])
+                if token.string in self.RENAMES
+                else None
+                for token in tokens
+            ]
+
+        def visit_all_number(self, tokens, indexes):
+            return {indexes[-1]: tokens[-1]._replace(string="0")}
+
+        def visit_name(self, token):
+            raise AssertionError("batched types are not visited per token")
+
+    foo = Foo()
+    assert foo.transform("foo(baz, x, 1, 2)\n") == "bar(qux, x, 1, 0)\n"
+    assert foo.matches("x = 1\n")
+    assert not foo.matches("x = y\n")
+
+
+IMPORTS_TRANSFORMER = """
+from brm import Anchor, TokenTransformer, pattern
+
+class Imports(TokenTransformer):
+    @pattern("name=import", "name", anchor=Anchor.LINE)
+    def star(self, keyword, name):
+        return [keyword, name._replace(string=name.string.upper())]
+
+    @pattern("lpar", "*any", "rpar")
+    def call(self, lpar, *rest):
+        return None
+
+    def visit_number(self, token):
+        if token.string == "2":
+            return token._replace(string="3")
+"""
+
+
+def test_compile_transformer(transformer_path):
+    (transformer_path / "dollar.py").write_text(DOLLAR_TRANSFORMER)
+    (transformer_path / "lsqb.py").write_text(LSQB_TRANSFORMER)
+    (transformer_path / "imports.py").write_text(IMPORTS_TRANSFORMER)
+    source = "import foo\nx = [1] $ 2\n(import bar)\n"
+
+    def transform(source):
+        for transformer in brm.get_transformers():
+            source = transformer.transform(source)
+        return source
+
+    expected = transform(source)
+    assert expected == "import FOO\nx = [0] == 3\n(import bar)\n"
+
+    brm.main(["compile-transformer"])
+    assert {path.name for path in brm.COMPILED_PATH.iterdir()} == {
+        "dollar__Dollar.py",
+        "lsqb__Index.py",
+        "imports__Imports.py",
+    }
+    transformers = list(brm.get_transformers())
+    assert all(
+        type(transformer).__module__.endswith(
+            f"__{type(transformer).__name__}"
+        )
+        for transformer in transformers
+    )
+    assert transform(source) == expected
+    # the fast engine is used when it can step through every pattern
+    assert {
+        type(transformer).__name__: transformer.ENGINE
+        for transformer in transformers
+    } == {"Dollar": None, "Index": "fast", "Imports": None}
+
+    # a stale compiled module is ignored
+    (transformer_path / "lsqb.py").write_text(
+        LSQB_TRANSFORMER.replace('"0"', '"1"')
+    )
+    assert "x = [1]" in transform(source)
+    assert len(list(brm._get_transformer_paths())) == 3
+
+
+def test_cli_compile_transformer(run_brm):
+    process = run_brm("compile-transformer")
+    output, _ = process.communicate()
+    assert process.returncode == 0
+    assert output.splitlines() == [
+        str(run_brm.home / ".brm" / ".compiled" / "dollar__Dollar.py")
+    ]
+
+
+def test_decode_populates_linecache(
+    transformer_path, tmp_path_factory, monkeypatch
+):
+    import codecs
+    import importlib
+    import inspect
+    import linecache
+
+    (transformer_path / "dollar.py").write_text(DOLLAR_TRANSFORMER)
+    package = tmp_path_factory.mktemp("package")
+    (package / "brm_linecache_module.py").write_text(
+        "# coding: brm\ndef check(a, b):\n    return a $ b\n"
+    )
+    codecs.register(brm.search)
+    monkeypatch.syspath_prepend(str(package))
+    monkeypatch.delitem(sys.modules, "brm_linecache_module", raising=False)
+
+    transforms = []
+    transform = TokenTransformer.transform
+
+    def counted_transform(self, source, *args, **kwargs):
+        transforms.append(source)
+        return transform(self, source, *args, **kwargs)
+
+    monkeypatch.setattr(TokenTransformer, "transform", counted_transform)
+
+    module = importlib.import_module("brm_linecache_module")
+    assert module.check(1, 1)
+    assert len(transforms) == 1
+    assert module.__file__ in linecache.cache
+    expected = "def check(a, b):\n    return a == b\n"
+    assert inspect.getsource(module.check) == expected
+
+    # re-reading the file through the codec reuses the transformed source
+    linecache.clearcache()
+    assert inspect.getsource(module.check) == expected
+    assert len(transforms) == 1
+
+
+def test_profile_import_registers_once(monkeypatch):
+    import codecs
+
+    registered = []
+    monkeypatch.setattr(brm, "_SEARCH_REGISTERED", False)
+    monkeypatch.setattr(codecs, "register", registered.append)
+    brm.profile_import("json")
+    brm.profile_import("json")
+    assert registered == [brm.search]
+
+
+def test_importtime(transformer_path, tmp_path_factory, monkeypatch, capsys):
+    (transformer_path / "dollar.py").write_text(DOLLAR_TRANSFORMER)
+    package = tmp_path_factory.mktemp("package")
+    source = "# coding: brm\ndef check(a, b):\n    return a $ b\n"
+    (package / "brm_importtime_module.py").write_text(source)
+    monkeypatch.syspath_prepend(str(package))
+    monkeypatch.delitem(sys.modules, "brm_importtime_module", raising=False)
+
+    brm.main(["importtime", "brm_importtime_module", "--json"])
+    report = json.loads(capsys.readouterr().out)
+    assert 0 < report["decode_time"] <= report["total_time"]
+    assert 0 < report["decode_share"] <= 1
+
+    [entry] = report["modules"]
+    assert entry["module"] == "brm_importtime_module"
+    assert entry["bytes"] == len(source)
+    assert entry["tokens"] > 0
+    assert list(entry["transformers"]) == ["Dollar"]
+
+
+NOT_EQUAL_TRANSFORMER = """
+from brm import TokenTransformer
+
+class NotEqual(TokenTransformer):
+    def visit_eqequal(self, token):
+        return token._replace(string="!=")
+
+    def visit_number(self, token):
+        return token._replace(string=str(int(token.string) * 2))
+"""
+
+FOO_TRANSFORMER = """
+from brm import TokenTransformer, pattern
+
+class Foo(TokenTransformer):
+    @pattern("name=foo")
+    def rename(self, name):
+        return [name._replace(string="bar")]
+"""
+
+BAR_TRANSFORMER = """
+from brm import TokenTransformer
+
+class Bar(TokenTransformer):
+    def visit_name(self, token):
+        if token.string == "bar":
+            return token._replace(string="baz")
+"""
+
+SLOW_TRANSFORMER = """
+import time
+from brm import TokenTransformer
+
+class Slow(TokenTransformer):
+    def visit_name(self, token):
+        time.sleep(0.1)
+        return token._replace(string="slow")
+"""
+
+
+def test_decode_fuses_transformers(transformer_path, monkeypatch):
+    import codecs
+
+    (transformer_path / "a_dollar.py").write_text(DOLLAR_TRANSFORMER)
+    (transformer_path / "b_not_equal.py").write_text(NOT_EQUAL_TRANSFORMER)
+    (transformer_path / "c_lsqb.py").write_text(LSQB_TRANSFORMER)
+    source = "a[3] $ b[4]\nc = a == 2\n"
+
+    transformers = list(brm.get_transformers(source))
+    sequential = source
+    for transformer in transformers:
+        sequential = transformer.transform(sequential)
+    assert sequential == "a[0] != b[0]\nc = a != 4\n"
+
+    fused = []
+    transform_fused = brm._transform_fused
+
+    def counted_transform_fused(transformers, source):
+        fused.append(len(transformers))
+        return transform_fused(transformers, source)
+
+    monkeypatch.setattr(brm, "_transform_fused", counted_transform_fused)
+    monkeypatch.setattr(brm, "_DECODED", {})
+    output, _ = brm.decode(source.encode(), encoding=codecs.lookup("utf8"))
+    assert output == sequential
+    assert fused == [3]
+
+    # the fused output is cached like the sequential one
+    output, _ = brm.decode(source.encode(), encoding=codecs.lookup("utf8"))
+    assert output == sequential
+    assert fused == [3]
+
+    # the visitors can not run before the patterns of an earlier transformer
+    (transformer_path / "d_foo.py").write_text(FOO_TRANSFORMER)
+    (transformer_path / "e_bar.py").write_text(BAR_TRANSFORMER)
+    output, _ = brm.decode(b"foo = bar\n", encoding=codecs.lookup("utf8"))
+    assert output == "baz = baz\n"
+    assert fused == [3, 2]
+
+
+def test_decode_fused_budget(transformer_path, monkeypatch):
+    import codecs
+
+    (transformer_path / "a_dollar.py").write_text(DOLLAR_TRANSFORMER)
+    (transformer_path / "b_lsqb.py").write_text(
+        LSQB_TRANSFORMER.replace(
+            "(TokenTransformer):",
+            "(TokenTransformer):\n    MAX_ATTEMPTS = 0\n",
+        )
+    )
+    transforms = []
+    transform = TokenTransformer.transform
+
+    def counted_transform(self, source, *args, **kwargs):
+        transforms.append(type(self).__name__)
+        return transform(self, source, *args, **kwargs)
+
+    monkeypatch.setattr(TokenTransformer, "transform", counted_transform)
+    monkeypatch.setattr(brm, "_DECODED", {})
+    with pytest.warns(BudgetWarning, match="Index skipped"):
+        output, _ = brm.decode(b"a[1] $ 2\n", encoding=codecs.lookup("utf8"))
+    assert output == "a[1] == 2\n"
+    # only the other transformer runs again
+    assert transforms == ["Dollar"]
+
+
+def test_decode_fused_budget_per_transformer(transformer_path, monkeypatch):
+    import codecs
+
+    (transformer_path / "a_fast.py").write_text(
+        NOT_EQUAL_TRANSFORMER.replace(
+            "(TokenTransformer):", "(TokenTransformer):\n    MAX_TIME = 0.05\n"
+        )
+    )
+    (transformer_path / "b_slow.py").write_text(SLOW_TRANSFORMER)
+    monkeypatch.setattr(brm, "_DECODED", {})
+
+    # the time of the other transformer's visitors is not charged to it
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", BudgetWarning)
+        output, _ = brm.decode(b"a == 2\n", encoding=codecs.lookup("utf8"))
+    assert output == "slow != 4\n"
+
+
+def test_find_brm_files(transformer_path, tmp_path_factory):
+    root = tmp_path_factory.mktemp("tree")
+    (root / "package" / "nested").mkdir(parents=True)
+    (root / ".hidden").mkdir()
+    files = {
+        "a.py": b"# coding: brm\nx = 1\n",
+        "package/b.py": (
+            b"#!/usr/bin/env python\n# -*- coding: brm-latin-1 -*-\n"
+        ),
+        "package/nested/c.py": b"\xef\xbb\xbf# coding: brm.lsqb-utf8",
+        "package/d.py": b"x = 1\n# coding: brm\n",
+        "package/e.py": b"\n\n# coding: brm\n",
+        "package/f.py": b"",
+        "package/g.txt": b"# coding: brm\n",
+        ".hidden/h.py": b"# coding: brm\n",
+        "i.py": b"# coding: latin-1\n# brm\n",
+    }
+    for name, content in files.items():
+        (root / name).write_bytes(content)
+
+    assert sorted(brm.find_brm_files(root, workers=2)) == [
+        (root / "a.py", "utf8"),
+        (root / "package/b.py", "latin-1"),
+        (root / "package/nested/c.py", "utf8"),
+    ]
+
+
+def test_token_transformer_engines(monkeypatch):
+    class Foo(TokenTransformer):
+        @pattern("name=import", "name", anchor=Anchor.LINE)
+        def imports(self, keyword, name):
+            return [keyword, name._replace(string=name.string.upper())]
+
+        @pattern("lsqb", "number", "rsqb")
+        def zero(self, lsqb, number, rsqb):
+            return [lsqb, number._replace(string="0"), rsqb]
+
+        @pattern("lpar", "any", "rpar")
+        def call(self, lpar, *rest):
+            return None
+
+    source = "import foo\nx = (import bar)[1]\nif x:\n    import baz\n"
+    expected = "import FOO\nx = (import bar)[0]\nif x:\n    import BAZ\n"
+    assert Foo().transform(source) == expected
+
+    class Bar(Foo):
+        ENGINE = "fast"
+
+    assert isinstance(Bar()._get_engine(), brm.StepEngine)
+    assert Bar().transform(source) == expected
+
+    monkeypatch.setattr(brm, "DEFAULT_ENGINE", "fast")
+    assert isinstance(Foo()._get_engine(), brm.StepEngine)
+    assert Foo().transform(source) == expected
+
+    Bar.ENGINE = "unknown"
+    with pytest.raises(PatternError):
+        Bar().transform(source)
+
+
+class ZeroIndex(TokenTransformer):
+    def register_dollar(self):
+        return "$"
+
+    def visit_dollar(self, token):
+        return token._replace(string="==", type=tokenize.OP)
+
+    @pattern("lsqb", "number", "rsqb")
+    def zero(self, lsqb, number, rsqb):
+        return [lsqb, number._replace(string="0"), rsqb]
+
+
+@pytest.mark.skipif(
+    brm.shared_memory is None, reason="requires multiprocessing.shared_memory"
+)
+def test_transform_many():
+    transformer = ZeroIndex()
+    source = "x = 'ü' + a[1] $ b[2]\nif x:\n    y = [3]\n"
+    stream_tokens = transformer.quick_tokenize(source, strip=False)
+    token_buffer = brm.TokenBuffer(brm.TokenBuffer.encode(stream_tokens))
+    assert len(token_buffer) == len(stream_tokens)
+    assert token_buffer[-1] == stream_tokens[-1]._replace(line="")
+    assert [stream_token[:4] for stream_token in token_buffer] == [
+        stream_token[:4] for stream_token in stream_tokens
+    ]
+
+    sources = [source, "z = [4]\n", "", source.replace("1", "5")]
+    assert list(brm.transform_many(transformer, sources, workers=2)) == [
+        transformer.transform(source) for source in sources
+    ]
+
+    # the memory of the shared sources is released when one of them can not
+    # be tokenized
+    segments = (
+        set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else None
+    )
+    with pytest.raises(tokenize.TokenError):
+        list(brm.transform_many(transformer, [*sources, "def (:\n"]))
+    if segments is not None:
+        assert set(os.listdir("/dev/shm")) <= segments
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_transform_batch(use_numpy, monkeypatch):
+    if use_numpy and brm._import_numpy() is None:
+        pytest.skip("requires numpy")
+    elif not use_numpy:
+        monkeypatch.setattr(brm, "_import_numpy", lambda: None)
+
+    transformer = ZeroIndex()
+    sources = [
+        "x = a[1] $ b\n",
+        "x = a[b] $ 1\n",
+        "",
+        "def f():\n    return [2]\n",
+        "y = [\n    1]\n",
+    ]
+    expected = [transformer.transform(source) for source in sources]
+
+    applied = []
+    apply_patterns = ZeroIndex._apply_patterns
+
+    def counted_apply_patterns(self, patterns, stream_tokens, *args):
+        applied.append(stream_tokens)
+        return apply_patterns(self, patterns, stream_tokens, *args)
+
+    monkeypatch.setattr(ZeroIndex, "_apply_patterns", counted_apply_patterns)
+    assert brm.transform_batch(transformer, sources) == expected
+    # only the sources with a [number] sequence are matched (the NL token
+    # in the last one breaks it)
+    assert len(applied) == 2
+
+    class Rename(TokenTransformer):
+        def dummy(self, token):
+            if token.string == "x":
+                return token._replace(string="y")
+
+    assert brm.transform_batch(Rename(), sources) == [
+        Rename().transform(source) for source in sources
+    ]
+
+
+def test_token_transformer_transform_iter():
+    class Foo(TokenTransformer):
+        @pattern("name=drop", "newline")
+        def drop(self, name, newline):
+            raise brm.NoLineTransposer
+
+        @pattern("lsqb", "number", "rsqb")
+        def zero(self, lsqb, number, rsqb):
+            return [lsqb, number._replace(string="0"), rsqb]
+
+        def visit_name(self, token):
+            if token.string == "foo":
+                return token._replace(string="bar")
+
+    source = (
+        "# comment\n"
+        "def foo(a,\n"
+        "        b=[1]):\n"
+        "\tif a:\n"
+        "\t\tdrop\n"
+        "\t\treturn a[2]  # x\n"
+        "\n"
+        "\treturn foo[3]\n"
+        "x = [4]"
+    )
+    foo = Foo()
+    expected = foo.transform(source)
+    assert expected.count("drop") == 0 and expected.count("[0]") == 4
+
+    lines = list(foo.transform_iter(io.StringIO(source).readline))
+    assert "".join(lines) == expected
+    assert all(line.count("\n") <= 1 for line in lines)
+
+    Foo.WINDOW = 3
+    assert "".join(foo.transform_iter(io.StringIO(source).readline)) == (
+        expected
+    )
+
+
+@pytest.fixture
+def remove_imports(monkeypatch):
+    if sys.version_info < (3, 8):
+        pytest.skip("the example requires python 3.8")
+    monkeypatch.syspath_prepend(
+        os.path.join(os.path.dirname(__file__), os.pardir, "examples")
+    )
+    import remove_imports
+
+    return remove_imports
+
+
+@pytest.mark.parametrize(
+    "source, modules, names",
+    [
+        # aliased and star imports are kept (and their names referenced)
+        (
+            "import os as o\n"
+            "from sys import path as p\n"
+            "from re import *\n"
+            "import json, os.path\n"
+            "from io import StringIO, BytesIO\n"
+            "o, p\n",
+            ["json"],
+            ["BytesIO", "StringIO"],
+        ),
+        # relative imports
+        (
+            "from . import foo\nfrom .bar import baz\nimport bar\n",
+            [],
+            [],
+        ),
+        # names used only in strings or __all__
+        (
+            "import json\nimport os\nfrom io import StringIO\n"
+            "__all__ = ['StringIO']\n"
+            "x: 'json.JSONDecoder'\n",
+            ["os"],
+            [],
+        ),
+        # the sole statement of a block
+        (
+            "if True:\n    import re\nimport os\n"
+            "try:\n    from io import StringIO\nexcept ImportError:\n"
+            "    from StringIO import StringIO\n",
+            ["os"],
+            [],
+        ),
+    ],
+)
+def test_remove_imports_removals(remove_imports, source, modules, names):
+    index = remove_imports.scan_source(source)
+    assert remove_imports.get_removals(index) == (modules, names)